@@ -1,17 +1,30 @@
-from flask import Flask, jsonify, request, render_template, session, redirect, url_for
+from flask import Flask, jsonify, request, render_template, session, redirect, url_for, Response, stream_with_context, g, send_file
 from functools import wraps
 import os
+import sys
 import subprocess
 import sqlite3
 import json
 import shutil
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 import bcrypt
 import socket
 import threading
 import time
 import re
+import queue
+import signal
+import hashlib
+import zlib
+import gzip
+import struct
+import secrets
+import bisect
+import tempfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from authlib.integrations.flask_client import OAuth
 import requests
 
@@ -24,10 +37,86 @@ BASE_DIR = os.getenv('BASE_DIR', 'C:\\developer\\')
 # 경로가 끝에 백슬래시가 없으면 추가
 if BASE_DIR and not BASE_DIR.endswith(os.sep):
     BASE_DIR += os.sep
-DB_FILE = "chat_history.db"
+DB_FILE = os.getenv('DB_FILE', 'chat_history.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))  # 재사용할 SQLite 연결 수
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))  # 잠금 대기 시간(ms)
+HISTORY_COMPRESS_MIN_BYTES = int(os.getenv('HISTORY_COMPRESS_MIN_BYTES', '1024'))  # 이 크기 이상인 응답만 압축 (0이면 압축 안 함)
+HISTORY_COMPRESS_LEVEL = int(os.getenv('HISTORY_COMPRESS_LEVEL', '6'))  # zlib 압축 레벨 (1-9)
+HISTORY_COMPRESS_DICT = os.getenv('HISTORY_COMPRESS_DICT')  # 공유 사전으로 쓸 샘플 파일 경로 (선택)
 SERVER_PORT = int(os.getenv('SERVER_PORT', '5000'))  # 서버 포트
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')  # 관리자 사용자명
 
+# --- Job Queue Configuration ---
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))  # CLI 실행 워커 스레드 수
+JOB_PROJECT_CONCURRENCY = int(os.getenv('JOB_PROJECT_CONCURRENCY', '2'))  # 프로젝트별 동시 실행 제한
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', '100'))  # 대기열 최대 길이 (초과 시 503 반환)
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', '3600'))  # 완료된 작업 결과 보관 시간
+
+# --- Project Watcher Configuration ---
+PROJECT_WATCH = os.getenv('PROJECT_WATCH', 'true').lower() in ('1', 'true', 'yes')  # 파일 감시 기반 프로젝트 목록 사용
+PROJECT_POLL_INTERVAL = float(os.getenv('PROJECT_POLL_INTERVAL', '10'))  # watchdog이 없을 때 폴링 주기(초)
+PROJECT_WATCH_DEBOUNCE = 0.5  # 연속된 파일 이벤트를 묶어서 처리할 대기 시간(초)
+
+# --- Warm CLI Worker Configuration ---
+CLI_WARM_WORKERS = os.getenv('CLI_WARM_WORKERS', 'false').lower() in ('1', 'true', 'yes')  # 세션별 상주 CLI 프로세스 사용
+CLI_WARM_MAX_PROCESSES = int(os.getenv('CLI_WARM_MAX_PROCESSES', '8'))  # 동시에 유지할 최대 프로세스 수
+CLI_WARM_IDLE_TIMEOUT = int(os.getenv('CLI_WARM_IDLE_TIMEOUT', '600'))  # 유휴 프로세스 종료 시간(초)
+
+# --- Conversation Context Configuration ---
+CONTEXT_HISTORY = os.getenv('CONTEXT_HISTORY', 'true').lower() in ('1', 'true', 'yes')  # 같은 세션의 이전 대화를 프롬프트 앞에 붙임
+CONTEXT_MAX_CHARS = int(os.getenv('CONTEXT_MAX_CHARS', '16000'))  # 붙일 맥락의 최대 길이(문자, 대략 토큰 수 x 4)
+CONTEXT_MAX_TURNS = int(os.getenv('CONTEXT_MAX_TURNS', '20'))  # 맥락에 포함할 최대 이전 턴 수
+CONTEXT_SUMMARY_CHARS = int(os.getenv('CONTEXT_SUMMARY_CHARS', '160'))  # 요약한 오래된 턴의 질문/답변별 최대 길이
+CONTEXT_CACHE_SESSIONS = int(os.getenv('CONTEXT_CACHE_SESSIONS', '256'))  # 맥락을 메모리에 유지할 세션 수
+
+# --- CLI Output Capture Configuration ---
+OUTPUT_MEMORY_LIMIT = int(os.getenv('OUTPUT_MEMORY_LIMIT', str(1024 * 1024)))  # 이 크기(바이트)를 넘는 CLI 출력은 파일로 넘김
+OUTPUT_PREVIEW_CHARS = int(os.getenv('OUTPUT_PREVIEW_CHARS', '20000'))  # 파일로 넘긴 출력 중 응답/히스토리에 남길 앞부분 길이
+OUTPUT_DIR = os.getenv('OUTPUT_DIR') or os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), 'cli_outputs')
+OUTPUT_STDERR_TAIL_BYTES = 64 * 1024  # 오류 메시지용으로 보관할 stderr의 마지막 부분 크기
+
+# --- Rate Limit Configuration ---
+# CLI를 실행하는 쿼리에 사용자별/프로젝트별 토큰 버킷을 적용합니다. BURST는 한 번에 보낼 수 있는 수, RATE는 초당 채워지는 토큰 수
+RATE_LIMIT = os.getenv('RATE_LIMIT', 'true').lower() in ('1', 'true', 'yes')
+RATE_LIMIT_USER_BURST = float(os.getenv('RATE_LIMIT_USER_BURST', '10'))
+RATE_LIMIT_USER_RATE = float(os.getenv('RATE_LIMIT_USER_RATE', '0.5'))
+RATE_LIMIT_PROJECT_BURST = float(os.getenv('RATE_LIMIT_PROJECT_BURST', '20'))
+RATE_LIMIT_PROJECT_RATE = float(os.getenv('RATE_LIMIT_PROJECT_RATE', '1'))
+RATE_LIMIT_MAX_WAIT = float(os.getenv('RATE_LIMIT_MAX_WAIT', '10'))  # 토큰을 기다리는 최대 시간(초), 넘으면 429 (0이면 바로 거절)
+
+# --- Response Cache Configuration ---
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'false').lower() in ('1', 'true', 'yes')  # 같은 질문의 응답 재사용
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '86400'))  # 캐시 항목 유효 시간(초)
+RESPONSE_CACHE_MEMORY_ENTRIES = int(os.getenv('RESPONSE_CACHE_MEMORY_ENTRIES', '256'))  # 메모리 LRU 항목 수
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))  # 디스크 캐시 최대 크기
+RESPONSE_CACHE_MAX_FILES = int(os.getenv('RESPONSE_CACHE_MAX_FILES', '20000'))  # 지문 계산 시 확인할 최대 파일 수
+RESPONSE_CACHE_FINGERPRINT_TTL = float(os.getenv('RESPONSE_CACHE_FINGERPRINT_TTL', '2'))  # 프로젝트 지문 재사용 시간(초)
+
+# --- Production Server Configuration (serve.py) ---
+WEB_WORKERS = max(1, int(os.getenv('WEB_WORKERS', '1')))  # 워커 프로세스 수
+WEB_THREADS = int(os.getenv('WEB_THREADS', '16'))  # 워커별 요청 처리 스레드 수 (SSE 연결도 하나씩 차지)
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')  # 바인딩할 주소
+CANCEL_POLL_INTERVAL = 0.5  # 다른 워커가 받은 취소 요청을 확인하는 주기(초)
+
+def per_worker(limit):
+    """
+    서버 전체에 대한 동시 실행 제한을 워커 프로세스 하나의 몫으로 나눕니다 (최소 1, None이면 제한 없음).
+    백엔드 슬롯, 작업 큐 워커, 상주 프로세스 수는 프로세스 메모리에 있으므로 워커마다 따로 셉니다.
+    """
+    if limit is None:
+        return None
+    return max(1, int(limit) // WEB_WORKERS)
+
+# --- HTTP Compression Configuration ---
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', '1024'))  # 이 크기 이상인 응답만 압축 (0이면 압축 안 함)
+COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', '6'))  # gzip 압축 레벨 (1-9)
+COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', '5'))  # brotli 품질 (0-11)
+
+# --- Metrics Configuration ---
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')  # 설정하면 로그인 없이 Authorization: Bearer <token>으로 /metrics 조회 가능
+# 지연 시간 히스토그램 구간(초). CLI 실행은 수십 초까지 걸리므로 넓게 잡음
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
 # --- Authentication Configuration ---
 # 허가된 사용자 목록은 .env 파일에서 로드됩니다.
 # 형식: ALLOWED_USERS=username1:hashed_password1,username2:hashed_password2
@@ -91,8 +180,9 @@ def load_allowed_oauth_users():
 ALLOWED_OAUTH_USERS = load_allowed_oauth_users()
 
 app = Flask(__name__)
-# It is recommended to use a more secure and persistent secret key in a real environment.
-app.secret_key = os.urandom(24)
+# SECRET_KEY가 없으면 init_db()에서 DB(app_state)에 저장된 키를 읽어 옵니다 (없으면 생성).
+# 모든 워커 프로세스가 같은 키를 쓰므로 워커가 재시작되거나 다른 워커가 요청을 받아도 세션이 유지됩니다.
+app.secret_key = os.getenv('SECRET_KEY') or os.urandom(24)
 
 # --- OAuth Setup ---
 oauth = OAuth(app)
@@ -126,33 +216,405 @@ if github_client_id and github_client_secret:
     )
 
 # --- Login Attempt Tracking ---
-# 서버 메모리에 저장 (서버 재시작 시 초기화됨)
-login_attempts = {}  # IP 주소별 시도 횟수
-account_locked = False  # 전체 계정 잠금 상태
+# IP 주소별 시도 횟수(login_attempts 테이블)와 전체 계정 잠금 상태(app_state.account_locked)는
+# DB에 저장하여 워커 프로세스 간에 공유합니다. 서버 시작 시 reset_login_state()로 초기화됩니다.
 
 # --- Database Setup ---
+class ConnectionPool:
+    """
+    SQLite 연결을 재사용하는 간단한 풀입니다.
+    요청마다 connect/close 하는 대신 연결을 빌려 쓰고 반납하므로,
+    연결별 statement cache(prepared statement)도 요청 간에 재사용됩니다.
+    """
+
+    def __init__(self, db_file, size):
+        self.db_file = db_file
+        self.size = max(1, size)
+        self.idle = queue.LifoQueue()
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,  # 풀에서 스레드 간에 넘겨 쓰므로 필요
+            cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        # 압축 저장된 응답을 SQL(조회, 검색 인덱스의 content 뷰)에서 바로 풀 수 있도록 등록
+        conn.create_function('decompress_message', 1, decompress_message, deterministic=True)
+        # WAL: 쓰기 중에도 읽기가 막히지 않음. NORMAL은 WAL에서 안전하면서 fsync 횟수를 줄임.
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        return conn
+
+    @contextmanager
+    def connection(self):
+        """풀에서 연결을 빌려 with 블록 동안 사용하고 반납합니다."""
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            conn = self._open()
+        try:
+            yield conn
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self.idle.qsize() < self.size:
+                self.idle.put(conn)
+            else:
+                conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+db_pool = ConnectionPool(DB_FILE, DB_POOL_SIZE)
+SESSION_PREVIEW_LENGTH = 100  # 세션 목록에 표시할 첫 메시지 길이
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))  # /api/history 기본 페이지 크기
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', '500'))  # 요청 가능한 최대 페이지 크기
+HISTORY_STREAM_BATCH = 500  # 스트리밍 응답에서 한 번에 읽는 행 수
+# history 조회 시 선택할 컬럼 (assistant_message는 압축을 풀어서 반환)
+HISTORY_COLUMNS = "id, projectId, sessionId, timestamp, cli, user_message, decompress_message(assistant_message) AS assistant_message, output_size"
+HISTORY_FTS = False  # history_fts(FTS5) 인덱스 사용 가능 여부 (init_db에서 확인)
+SEARCH_PAGE_SIZE = 20  # /api/history/search 기본 페이지 크기
+SEARCH_MAX_TERMS = 16  # 검색어에서 사용할 최대 단어 수
+
+# --- Message Compression ---
+# 압축된 assistant_message는 BLOB으로 저장하며 첫 바이트가 형식을 나타냅니다. TEXT 값은 압축하지 않은 원문입니다.
+COMPRESSED_ZLIB = 0x01  # zlib
+COMPRESSED_ZLIB_DICT = 0x02  # zlib + 공유 사전 (다음 4바이트: compression_dicts.id)
+COMPRESSION_DICTS = {}  # id: 사전 bytes (init_db에서 로드)
+CURRENT_DICT_ID = None  # 새로 압축할 때 사용할 사전 id
+
+def compress_message(text):
+    """HISTORY_COMPRESS_MIN_BYTES 이상이면 압축한 BLOB을, 아니면 원문을 반환합니다."""
+    if not HISTORY_COMPRESS_MIN_BYTES or text is None:
+        return text
+    data = text.encode('utf-8')
+    if len(data) < HISTORY_COMPRESS_MIN_BYTES:
+        return text
+    if CURRENT_DICT_ID is not None:
+        compressor = zlib.compressobj(HISTORY_COMPRESS_LEVEL, zdict=COMPRESSION_DICTS[CURRENT_DICT_ID])
+        compressed = struct.pack('>BI', COMPRESSED_ZLIB_DICT, CURRENT_DICT_ID) + compressor.compress(data) + compressor.flush()
+    else:
+        compressed = bytes([COMPRESSED_ZLIB]) + zlib.compress(data, HISTORY_COMPRESS_LEVEL)
+    # 압축 효과가 없으면 원문 유지
+    return compressed if len(compressed) < len(data) else text
+
+def decompress_message(value):
+    """compress_message로 저장된 값을 원문 문자열로 되돌립니다."""
+    if not isinstance(value, bytes):
+        return value
+    if value[0] == COMPRESSED_ZLIB:
+        return zlib.decompress(value[1:]).decode('utf-8')
+    if value[0] == COMPRESSED_ZLIB_DICT:
+        dict_id = struct.unpack_from('>I', value, 1)[0]
+        decompressor = zlib.decompressobj(zdict=COMPRESSION_DICTS[dict_id])
+        return (decompressor.decompress(value[5:]) + decompressor.flush()).decode('utf-8')
+    return value.decode('utf-8')
+
+def load_compression_dicts(conn):
+    """
+    저장된 공유 사전을 로드합니다. HISTORY_COMPRESS_DICT 파일이 지정되어 있고 그 내용이 아직 없으면 새 사전으로 등록합니다.
+    사전은 한 번 등록되면 지우지 않으므로 예전 사전으로 압축된 행도 계속 읽을 수 있습니다.
+    """
+    global CURRENT_DICT_ID
+    if HISTORY_COMPRESS_DICT:
+        with open(HISTORY_COMPRESS_DICT, 'rb') as f:
+            # zlib 사전은 마지막 32KB만 사용됨
+            data = f.read()[-32768:]
+        if not conn.execute('SELECT 1 FROM compression_dicts WHERE data = ?', (data,)).fetchone():
+            conn.execute('INSERT INTO compression_dicts (data, created_at) VALUES (?, ?)', (data, time.time()))
+            conn.commit()
+    for row in conn.execute('SELECT id, data FROM compression_dicts'):
+        COMPRESSION_DICTS[row['id']] = bytes(row['data'])
+    CURRENT_DICT_ID = None
+    if HISTORY_COMPRESS_DICT:
+        CURRENT_DICT_ID = conn.execute(
+            'SELECT id FROM compression_dicts WHERE data = ?', (data,)
+        ).fetchone()[0]
+
 def init_db():
     """Initializes the database and creates the history table if it doesn\'t exist."""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    global HISTORY_FTS
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                projectId TEXT NOT NULL,
+                sessionId TEXT,
+                timestamp DATETIME NOT NULL,
+                cli TEXT NOT NULL,
+                user_message TEXT NOT NULL,
+                assistant_message TEXT NOT NULL
+            )
+        ''')
+        # sessionId 컬럼이 없으면 추가 (기존 데이터베이스 마이그레이션)
+        try:
+            cursor.execute('ALTER TABLE history ADD COLUMN sessionId TEXT')
+        except sqlite3.OperationalError:
+            pass  # 컬럼이 이미 존재하는 경우
+        conn.commit()
+
+        # 스키마 버전(PRAGMA user_version)에 따라 순서대로 마이그레이션 적용
+        version = cursor.execute('PRAGMA user_version').fetchone()[0]
+        for target_version, migrate in enumerate(SCHEMA_MIGRATIONS, start=1):
+            if version < target_version:
+                migrate(cursor)
+                cursor.execute(f'PRAGMA user_version = {target_version}')
+                conn.commit()
+
+        load_compression_dicts(conn)
+
+    load_secret_key()
+    with db_pool.connection() as conn:
+        HISTORY_FTS = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_fts'"
+        ).fetchone() is not None
+
+def migrate_add_indexes_and_sessions(cursor):
+    """
+    history 조회용 인덱스와 세션 요약(sessions) 테이블을 추가하고,
+    기존 history 데이터로 sessions 테이블을 채웁니다.
+    """
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE INDEX IF NOT EXISTS idx_history_project_timestamp
+        ON history (projectId, timestamp)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_history_project_session
+        ON history (projectId, sessionId, timestamp)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sessions (
+            sessionId TEXT NOT NULL,
             projectId TEXT NOT NULL,
-            sessionId TEXT,
-            timestamp DATETIME NOT NULL,
-            cli TEXT NOT NULL,
-            user_message TEXT NOT NULL,
-            assistant_message TEXT NOT NULL
+            first_message TEXT NOT NULL,
+            started_at DATETIME NOT NULL,
+            last_at DATETIME NOT NULL,
+            turn_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (projectId, sessionId)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_sessions_project_started
+        ON sessions (projectId, started_at)
+    ''')
+    # 기존 데이터 채우기: 세션별 첫 메시지(MIN(id))와 시작/마지막 시각, 턴 수
+    cursor.execute('''
+        INSERT OR IGNORE INTO sessions (sessionId, projectId, first_message, started_at, last_at, turn_count)
+        SELECT s.sessionId, s.projectId, h.user_message, s.started_at, s.last_at, s.turn_count
+        FROM (
+            SELECT sessionId, projectId, MIN(id) AS first_id, MIN(timestamp) AS started_at,
+                   MAX(timestamp) AS last_at, COUNT(*) AS turn_count
+            FROM history
+            WHERE sessionId IS NOT NULL
+            GROUP BY projectId, sessionId
+        ) s
+        JOIN history h ON h.id = s.first_id
+    ''')
+    cursor.execute('''
+        UPDATE sessions
+        SET first_message = substr(first_message, 1, ?) || '...'
+        WHERE length(first_message) > ?
+    ''', (SESSION_PREVIEW_LENGTH, SESSION_PREVIEW_LENGTH))
+
+def migrate_id_ordered_history_indexes(cursor):
+    """
+    /api/history의 keyset 페이지네이션(id 기준)을 위해 history 인덱스를 id 순서로 교체합니다.
+    """
+    cursor.execute('DROP INDEX IF EXISTS idx_history_project_timestamp')
+    cursor.execute('DROP INDEX IF EXISTS idx_history_project_session')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_history_project_id
+        ON history (projectId, id)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_history_project_session_id
+        ON history (projectId, sessionId, id)
+    ''')
+
+def migrate_add_response_cache(cursor):
+    """
+    응답 캐시(response_cache) 테이블을 추가합니다. key는 (cli, model, message, 프로젝트 지문)의 해시입니다.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_response_cache_last_used
+        ON response_cache (last_used)
+    ''')
+
+def migrate_add_shared_state(cursor):
+    """
+    여러 워커 프로세스가 공유하는 상태를 위한 테이블을 추가합니다.
+    - app_state: 세션 secret key, 계정 잠금 상태 등 key/value
+    - login_attempts: IP 주소별 로그인 실패 횟수
+    - query_cancellations: 다른 워커에서 실행 중인 쿼리에 대한 취소 요청
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS login_attempts (
+            ip TEXT PRIMARY KEY,
+            attempts INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS query_cancellations (
+            query_id TEXT PRIMARY KEY,
+            username TEXT,
+            created_at REAL NOT NULL
         )
     ''')
-    # sessionId 컬럼이 없으면 추가 (기존 데이터베이스 마이그레이션)
+
+def migrate_add_history_fts(cursor):
+    """
+    대화 검색용 FTS5 인덱스(history_fts)를 추가하고 기존 history로 채웁니다.
+    내용은 history 테이블을 참조(external content)하므로 텍스트를 중복 저장하지 않습니다.
+    SQLite에 FTS5가 없으면 건너뛰며, 이 경우 /api/history/search는 501을 반환합니다.
+    """
     try:
-        cursor.execute('ALTER TABLE history ADD COLUMN sessionId TEXT')
-    except sqlite3.OperationalError:
-        pass  # 컬럼이 이미 존재하는 경우
-    conn.commit()
-    conn.close()
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(
+                user_message,
+                assistant_message,
+                content='history',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"WARNING: SQLite FTS5 is not available ({e}). History search is disabled.")
+        return
+    cursor.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+
+def migrate_compress_assistant_messages(cursor):
+    """
+    assistant_message 압축 저장을 도입합니다.
+    - compression_dicts: 공유 압축 사전
+    - 기존 행 중 HISTORY_COMPRESS_MIN_BYTES 이상인 응답을 압축
+    - 검색 인덱스(history_fts)의 content를 압축을 푼 뷰(history_plain)로 바꿔 다시 구성
+    디스크 파일 크기를 줄이려면 마이그레이션 후 한 번 VACUUM을 실행하세요.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS compression_dicts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data BLOB NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    load_compression_dicts(cursor.connection)
+
+    last_id = 0
+    while True:
+        rows = cursor.execute('''
+            SELECT id, assistant_message FROM history
+            WHERE id > ? AND typeof(assistant_message) = 'text'
+            ORDER BY id LIMIT ?
+        ''', (last_id, HISTORY_STREAM_BATCH)).fetchall()
+        if not rows:
+            break
+        updates = []
+        for row_id, message in rows:
+            compressed = compress_message(message)
+            if compressed is not message:
+                updates.append((compressed, row_id))
+        cursor.executemany('UPDATE history SET assistant_message = ? WHERE id = ?', updates)
+        last_id = rows[-1][0]
+
+    cursor.execute('''
+        CREATE VIEW IF NOT EXISTS history_plain AS
+        SELECT id, user_message, decompress_message(assistant_message) AS assistant_message
+        FROM history
+    ''')
+    if cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_fts'").fetchone():
+        cursor.execute('DROP TABLE history_fts')
+        cursor.execute('''
+            CREATE VIRTUAL TABLE history_fts USING fts5(
+                user_message,
+                assistant_message,
+                content='history_plain',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        cursor.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+
+def migrate_add_rate_limits(cursor):
+    """사용자별/프로젝트별 토큰 버킷 상태를 워커 프로세스끼리 공유하는 테이블을 추가합니다."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limits (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    ''')
+
+def migrate_add_output_reference(cursor):
+    """
+    파일로 넘긴 큰 CLI 출력의 참조를 저장할 컬럼을 추가합니다.
+    output_file은 OUTPUT_DIR 안의 파일 이름, output_size는 전체 출력 크기(바이트)이며,
+    이때 assistant_message에는 앞부분 미리보기만 저장됩니다.
+    """
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(history)')}
+    if 'output_file' not in columns:
+        cursor.execute('ALTER TABLE history ADD COLUMN output_file TEXT')
+    if 'output_size' not in columns:
+        cursor.execute('ALTER TABLE history ADD COLUMN output_size INTEGER')
+
+# 순서대로 적용되는 스키마 마이그레이션 목록 (인덱스 + 1 = user_version)
+SCHEMA_MIGRATIONS = [
+    migrate_add_indexes_and_sessions,
+    migrate_id_ordered_history_indexes,
+    migrate_add_response_cache,
+    migrate_add_shared_state,
+    migrate_add_history_fts,
+    migrate_compress_assistant_messages,
+    migrate_add_output_reference,
+    migrate_add_rate_limits,
+]
+
+def load_secret_key():
+    """
+    SECRET_KEY 환경 변수가 없으면 DB에 저장된 세션 secret key를 사용합니다.
+    처음 실행할 때 생성하며, 여러 워커가 동시에 시작해도 먼저 저장된 키 하나만 쓰입니다.
+    """
+    if os.getenv('SECRET_KEY'):
+        return
+    with db_pool.connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO app_state (key, value) VALUES ('secret_key', ?)",
+            (secrets.token_hex(32),)
+        )
+        conn.commit()
+        app.secret_key = conn.execute("SELECT value FROM app_state WHERE key = 'secret_key'").fetchone()[0]
+
+def reset_login_state():
+    """로그인 시도 횟수와 계정 잠금을 초기화합니다. 서버(런처) 시작 시 한 번 호출합니다."""
+    with db_pool.connection() as conn:
+        conn.execute('DELETE FROM login_attempts')
+        conn.execute("DELETE FROM app_state WHERE key = 'account_locked'")
+        conn.commit()
 
 # --- Authentication Helper Functions ---
 def get_client_ip():
@@ -163,39 +625,46 @@ def get_client_ip():
 
 def is_account_locked():
     """계정이 잠겨있는지 확인합니다."""
-    return account_locked
+    with db_pool.connection() as conn:
+        row = conn.execute("SELECT 1 FROM app_state WHERE key = 'account_locked'").fetchone()
+    return row is not None
 
 def increment_login_attempts():
     """로그인 시도 횟수를 증가시킵니다."""
-    global account_locked
     client_ip = get_client_ip()
-    
-    if client_ip not in login_attempts:
-        login_attempts[client_ip] = 0
-    
-    login_attempts[client_ip] += 1
-    
-    # 전체 시도 횟수가 MAX_LOGIN_ATTEMPTS를 초과하면 잠금
-    total_attempts = sum(login_attempts.values())
-    if total_attempts >= MAX_LOGIN_ATTEMPTS:
-        account_locked = True
-    
-    return login_attempts[client_ip]
+    with db_pool.connection() as conn:
+        # 여러 워커가 동시에 증가시켜도 잃어버리지 않도록 쓰기 잠금을 먼저 잡음
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('''
+            INSERT INTO login_attempts (ip, attempts) VALUES (?, 1)
+            ON CONFLICT(ip) DO UPDATE SET attempts = attempts + 1
+        ''', (client_ip,))
+        attempts = conn.execute('SELECT attempts FROM login_attempts WHERE ip = ?', (client_ip,)).fetchone()[0]
+
+        # 전체 시도 횟수가 MAX_LOGIN_ATTEMPTS를 초과하면 잠금
+        total_attempts = conn.execute('SELECT SUM(attempts) FROM login_attempts').fetchone()[0]
+        if total_attempts >= MAX_LOGIN_ATTEMPTS:
+            conn.execute("INSERT OR REPLACE INTO app_state (key, value) VALUES ('account_locked', '1')")
+        conn.commit()
+    return attempts
 
 def reset_login_attempts():
     """로그인 성공 시 시도 횟수를 초기화합니다."""
-    global account_locked
     client_ip = get_client_ip()
-    if client_ip in login_attempts:
-        del login_attempts[client_ip]
-    # 모든 시도가 초기화되면 잠금 해제
-    if not login_attempts:
-        account_locked = False
+    with db_pool.connection() as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('DELETE FROM login_attempts WHERE ip = ?', (client_ip,))
+        # 모든 시도가 초기화되면 잠금 해제
+        if not conn.execute('SELECT 1 FROM login_attempts LIMIT 1').fetchone():
+            conn.execute("DELETE FROM app_state WHERE key = 'account_locked'")
+        conn.commit()
 
 def get_login_attempts():
     """현재 로그인 시도 횟수를 반환합니다."""
     client_ip = get_client_ip()
-    return login_attempts.get(client_ip, 0)
+    with db_pool.connection() as conn:
+        row = conn.execute('SELECT attempts FROM login_attempts WHERE ip = ?', (client_ip,)).fetchone()
+    return row[0] if row else 0
 
 def is_admin():
     """현재 세션이 관리자인지 확인합니다."""
@@ -222,6 +691,14 @@ def is_port_in_use(port):
         except OSError:
             return True
 
+# 여러 포트를 동시에 확인할 때 사용하는 스레드 풀
+port_probe_executor = ThreadPoolExecutor(max_workers=int(os.getenv('PORT_PROBE_WORKERS', '16')), thread_name_prefix='port-probe')
+
+def check_ports_in_use(ports):
+    """여러 포트의 사용 여부를 동시에 확인하여 {port: bool}을 반환합니다."""
+    unique_ports = sorted({port for port in ports if port})
+    return dict(zip(unique_ports, port_probe_executor.map(is_port_in_use, unique_ports)))
+
 def kill_process_on_port(port):
     """특정 포트를 사용하는 프로세스를 종료합니다."""
     try:
@@ -301,7 +778,7 @@ def login_required(f):
     return decorated_function
 
 # --- Helper Functions ---
-def find_command(command_name):
+def resolve_command(command_name):
     """
     Finds the full path to a command by checking:
     1. System PATH using shutil.which()
@@ -334,96 +811,448 @@ def find_command(command_name):
     
     return None
 
-def get_projects():
-    """Scans the base directory for subdirectories and returns them as a list of projects."""
-    projects = []
-    if not os.path.isdir(BASE_DIR):
-        return []
-    for item in os.listdir(BASE_DIR):
-        full_path = os.path.join(BASE_DIR, item)
-        if os.path.isdir(full_path):
-            # 프로젝트에 run_server.bat이 있는지 확인
-            run_server_bat = os.path.join(full_path, 'run_server.bat')
-            restart_server_bat = os.path.join(full_path, 'restart_server.bat')
-            has_server = os.path.exists(run_server_bat) or os.path.exists(restart_server_bat)
-            
-            # 프로젝트의 포트 정보 확인 (app.py나 .env에서)
-            port = get_project_port(full_path)
-            
-            projects.append({
-                "id": item,
-                "name": item,
-                "path": full_path,
-                "has_server": has_server,
-                "port": port
-            })
-    return projects
+# --- Command Resolution Cache ---
+COMMAND_CACHE_TTL = int(os.getenv('COMMAND_CACHE_TTL', '300'))  # 명령어 경로 캐시 유지 시간(초)
+command_cache = {}  # command_name: (path 또는 None, resolved_at)
+command_cache_lock = threading.Lock()
 
-def get_project_port(project_path):
+def find_command(command_name):
     """
-    프로젝트 폴더에서 포트 정보를 찾습니다.
-    규칙:
-    1. .env 파일: SERVER_PORT=XXXX 또는 PORT=XXXX
-    2. app.py 파일: app.run(port=XXXX), PORT = XXXX, 또는 # @port: XXXX 주석
+    resolve_command()의 결과를 COMMAND_CACHE_TTL 동안 캐시하여 반환합니다.
+    찾지 못한 결과(None)도 캐시되므로, 도구를 새로 설치했다면 /api/commands/refresh를 호출하세요.
     """
-    def read_file_safe(file_path):
-        for encoding in ['utf-8', 'cp949', 'latin-1']:
+    with command_cache_lock:
+        cached = command_cache.get(command_name)
+    if cached and time.time() - cached[1] < COMMAND_CACHE_TTL:
+        return cached[0]
+    command_path = resolve_command(command_name)
+    with command_cache_lock:
+        command_cache[command_name] = (command_path, time.time())
+    return command_path
+
+def refresh_command_cache():
+    """지원하는 모든 CLI의 경로를 다시 찾고 {command_name: path}를 반환합니다. 없는 도구는 경고를 출력합니다."""
+    with command_cache_lock:
+        command_cache.clear()
+    resolved = {}
+    command_names = {backend.command_name for backend in CLI_BACKENDS.values() if backend.command_name}
+    for command_name in sorted(command_names):
+        resolved[command_name] = find_command(command_name)
+        if resolved[command_name]:
+            print(f"CLI '{command_name}': {resolved[command_name]}")
+        else:
+            print(f"WARNING: CLI '{command_name}' was not found in PATH. Queries using it will fail.")
+    return resolved
+
+# 포트/서버 감지에 사용하는 프로젝트 파일 (이 파일들의 변경만 재분석 대상)
+PROJECT_SIGNATURE_FILES = ('.port', '.env', 'app.py', 'run_server.bat', 'restart_server.bat')
+
+class ProjectCache:
+    """
+    프로젝트 메타데이터(has_server, port) 캐시입니다.
+    프로젝트 폴더를 os.scandir로 한 번 나열해 감지 대상 파일의 (mtime, size)를 서명으로 저장하고,
+    서명이 바뀐 프로젝트만 다시 분석합니다. 파일 내용을 열어 보는 일은 변경 시에만 일어납니다.
+    """
+
+    def __init__(self):
+        self.entries = {}  # project_id: (signature, project dict)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _signature(project_path):
+        signature = {}
+        try:
+            with os.scandir(project_path) as it:
+                for entry in it:
+                    name = entry.name.lower()
+                    if name in PROJECT_SIGNATURE_FILES:
+                        stat = entry.stat()
+                        signature[name] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+        return tuple(sorted(signature.items()))
+
+    @staticmethod
+    def _build(project_id, project_path, signature):
+        names = {name for name, _ in signature}
+        # 프로젝트에 run_server.bat이 있는지 확인
+        has_server = 'run_server.bat' in names or 'restart_server.bat' in names
+        port, port_source = detect_project_port(project_path)
+        return {
+            "id": project_id,
+            "name": project_id,
+            "path": project_path,
+            "has_server": has_server,
+            # 프로젝트의 포트 정보 확인 (app.py나 .env에서)
+            "port": port,
+            "port_source": port_source
+        }
+
+    def get(self, project_id, project_path):
+        """단일 프로젝트 정보를 반환합니다. 파일이 바뀌었으면 다시 분석합니다."""
+        signature = self._signature(project_path)
+        if signature is None:
+            return None
+        with self.lock:
+            cached = self.entries.get(project_id)
+        if cached and cached[0] == signature:
+            return cached[1]
+        info = self._build(project_id, project_path, signature)
+        with self.lock:
+            self.entries[project_id] = (signature, info)
+        return info
+
+    def scan(self):
+        """BASE_DIR의 모든 프로젝트 정보를 반환하고, 사라진 프로젝트는 캐시에서 제거합니다."""
+        if not os.path.isdir(BASE_DIR):
+            return []
+        projects = []
+        seen = set()
+        with os.scandir(BASE_DIR) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                info = self.get(entry.name, os.path.join(BASE_DIR, entry.name))
+                if info:
+                    projects.append(info)
+                    seen.add(entry.name)
+        with self.lock:
+            for project_id in set(self.entries) - seen:
+                del self.entries[project_id]
+        return projects
+
+    def invalidate(self, project_id=None):
+        """캐시를 비웁니다. project_id가 주어지면 해당 프로젝트만 비웁니다."""
+        with self.lock:
+            if project_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(project_id, None)
+
+project_cache = ProjectCache()
+
+class ProjectRegistry:
+    """
+    BASE_DIR을 감시하면서 프로젝트 목록을 메모리에 유지하고, 변경(added/removed/changed)을
+    구독자(SSE 연결)에게 전달합니다.
+    watchdog 패키지가 있으면 파일 시스템 이벤트(Linux: inotify, Windows: ReadDirectoryChangesW)를 사용하고,
+    없으면 PROJECT_POLL_INTERVAL 주기로 다시 스캔합니다. 분석은 project_cache가 담당합니다.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.projects = {}  # project_id: project dict
+        self.version = 0
+        self.mode = None  # 'watchdog' | 'polling' (시작 전에는 None)
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.dirty = set()  # 다시 분석할 project_id, None이면 전체 스캔
+        self.wakeup = threading.Event()
+        self.started = threading.Event()  # 첫 스캔이 끝나면 설정됨
+        self.observer = None
+        self.watched = {}  # project_id: watchdog watch 핸들
+
+    def ensure_started(self):
+        """감시 스레드를 처음 필요할 때 시작합니다. 비활성화되어 있으면 False를 반환합니다."""
+        if not PROJECT_WATCH:
+            return False
+        with self.lock:
+            starting = not self.mode
+            if starting:
+                self.mode = 'starting'
+            started = self.started
+        if not starting:
+            # 첫 스캔 중에 들어온 요청(첫 화면의 /api/projects, /api/projects/status)이 빈 목록을 받지 않도록 기다림
+            started.wait()
+            # 첫 스캔이 실패했으면 False를 반환하여 호출자가 직접 스캔하게 함
+            return self.mode is not None
+        try:
+            self.refresh()
+        except Exception:
+            # 다음 호출이 다시 시작하도록 시작 전 상태로 되돌림
+            with self.lock:
+                self.mode = None
+                self.started = threading.Event()
+            started.set()
+            raise
+        started.set()
+        mode = 'watchdog' if self._start_watchdog() else 'polling'
+        with self.lock:
+            self.mode = mode
+        threading.Thread(target=self._refresh_loop, name="project-watcher", daemon=True).start()
+        print(f"Project watcher started ({mode}).")
+        return True
+
+    def _start_watchdog(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            return False
+        if not os.path.isdir(BASE_DIR):
+            return False
+
+        registry = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                for path in (event.src_path, getattr(event, 'dest_path', '')):
+                    if path:
+                        registry._on_fs_event(path)
+
+        self.observer = Observer()
+        self.handler = Handler()
+        # node_modules 등을 피하기 위해 재귀 감시 대신 BASE_DIR과 각 프로젝트 루트만 감시
+        self.observer.schedule(self.handler, BASE_DIR, recursive=False)
+        for project_id in list(self.projects):
+            self._watch_project(project_id)
+        self.observer.daemon = True
+        self.observer.start()
+        return True
+
+    def _watch_project(self, project_id):
+        if not self.observer or project_id in self.watched:
+            return
+        try:
+            self.watched[project_id] = self.observer.schedule(
+                self.handler, os.path.join(BASE_DIR, project_id), recursive=False)
+        except OSError:
+            pass
+
+    def _unwatch_project(self, project_id):
+        watch = self.watched.pop(project_id, None)
+        if watch and self.observer:
             try:
-                with open(file_path, 'r', encoding=encoding) as f:
-                    return f.read()
-            except Exception:
-                continue
-        return None
+                self.observer.unschedule(watch)
+            except (KeyError, OSError):
+                pass
+
+    def _on_fs_event(self, path):
+        relative = os.path.relpath(path, BASE_DIR)
+        parts = relative.split(os.sep)
+        with self.lock:
+            if parts[0] in ('.', '..'):
+                self.dirty.add(None)
+            elif len(parts) == 1:
+                # BASE_DIR 바로 아래 항목(프로젝트 폴더) 추가/삭제/이름 변경
+                self.dirty.add(parts[0])
+            elif parts[1].lower() in PROJECT_SIGNATURE_FILES:
+                self.dirty.add(parts[0])
+            else:
+                return
+        self.wakeup.set()
+
+    def _refresh_loop(self):
+        while True:
+            timeout = None if self.mode == 'watchdog' else PROJECT_POLL_INTERVAL
+            triggered = self.wakeup.wait(timeout)
+            if triggered:
+                time.sleep(PROJECT_WATCH_DEBOUNCE)
+            self.wakeup.clear()
+            with self.lock:
+                dirty, self.dirty = self.dirty, set()
+            try:
+                if not triggered or None in dirty:
+                    self.refresh()
+                else:
+                    self.refresh(dirty)
+            except Exception as e:
+                print(f"Project watcher error: {e}")
+
+    def refresh(self, project_ids=None):
+        """프로젝트 정보를 다시 읽고 달라진 점을 구독자에게 알립니다. project_ids가 없으면 전체 스캔."""
+        if project_ids is None:
+            latest = {p['id']: p for p in self.cache.scan()}
+            targets = set(self.projects) | set(latest)
+        else:
+            latest = {}
+            for project_id in project_ids:
+                project_path = get_project_path(project_id)
+                info = self.cache.get(project_id, project_path) if project_path else None
+                if info:
+                    latest[project_id] = info
+                else:
+                    self.cache.invalidate(project_id)
+            targets = set(project_ids)
+
+        events = []
+        with self.lock:
+            for project_id in sorted(targets):
+                old, new = self.projects.get(project_id), latest.get(project_id)
+                if old == new:
+                    continue
+                if new is None:
+                    del self.projects[project_id]
+                    events.append(('removed', {"id": project_id}))
+                else:
+                    self.projects[project_id] = new
+                    events.append(('added' if old is None else 'changed', new))
+            if events:
+                self.version += 1
+            version = self.version
+
+        for event, data in events:
+            if event == 'added':
+                self._watch_project(data['id'])
+            elif event == 'removed':
+                self._unwatch_project(data['id'])
+            self._publish(event, dict(data, version=version))
+
+    def snapshot(self):
+        with self.lock:
+            return {"version": self.version, "projects": list(self.projects.values())}
+
+    def subscribe(self):
+        subscriber = queue.Queue(maxsize=256)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def _publish(self, event, data):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event, data))
+            except queue.Full:
+                # 너무 뒤처진 구독자는 전체 목록을 다시 받도록 함
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(('snapshot', self.snapshot()))
 
+project_registry = ProjectRegistry(project_cache)
+
+def get_projects():
+    """
+    Returns the list of projects.
+    감시가 켜져 있으면 메모리에 유지 중인 목록을 반환하고, 아니면 BASE_DIR을 스캔합니다.
+    """
+    if project_registry.ensure_started():
+        return project_registry.snapshot()['projects']
+    return project_cache.scan()
+
+# --- Port Detection ---
+# 파일별 포트 감지 규칙. 각 패턴은 하나의 정규식으로 합쳐져 파일을 한 번만 훑으며,
+# 어떤 규칙이 맞았는지는 그룹 이름으로 구분합니다. 순서가 곧 우선순위입니다.
+# 모든 패턴이 ASCII이므로 바이트 단위로 검사하며, utf-8/cp949/latin-1 모두 ASCII 호환이라
+# 파일 인코딩과 무관하게 결과가 같습니다 (디코딩은 매치된 숫자에만 적용).
+PORT_RULES = {
+    '.env': [
+        ('env_at_port', 'comment @port', rb'@port:\s*(?P<env_at_port_n>\d+)'),
+        ('env_assign', 'SERVER_PORT/PORT', rb'(?:SERVER_PORT|PORT)\s*=\s*(?P<env_assign_n>\d+)'),
+    ],
+    'app.py': [
+        ('py_at_port', 'comment @port', rb'@port:\s*(?P<py_at_port_n>\d+)'),
+        # app.run(port=XXXX) 또는 app.run(..., port=XXXX, ...)
+        ('py_run_port', 'app.run(port=...)', rb'port\s*=\s*(?P<py_run_port_n>\d+)'),
+        # SERVER_PORT = XXXX 또는 PORT = XXXX 패턴 (int() 감싸기 포함)
+        ('py_assign', 'SERVER_PORT/PORT', rb'(?:SERVER_PORT|PORT)\s*=\s*(?:int\()?(?P<py_assign_n>\d+)'),
+        # 마지막 수단: "port": 5000, "port" : 5000 등
+        ('py_literal', 'port literal', rb'(?i:port["\']?\s*[:=]\s*(?P<py_literal_n>\d{4,5}))'),
+    ],
+}
+# 모든 규칙은 'port'(대소문자 무시) 뒤에 [:=]가 오는 형태이므로, 소문자로 바꾼 청크에서 그런 위치만
+# 빠르게 찾은 뒤 그 위치('@port', 'SERVER_PORT'는 앞쪽으로 보정)에서만 합쳐진 패턴을 match 합니다.
+PORT_ANCHOR = re.compile(rb'port(?=["\']?\s*[:=])')
+PORT_ANCHOR_OFFSETS = (1, 7, 0)  # '@' 한 글자, 'SERVER_' 일곱 글자, 'port' 자체
+PORT_SCAN_CHUNK = 64 * 1024  # 한 번에 읽는 크기
+PORT_SCAN_OVERLAP = 4096  # 청크 경계(줄바꿈 포함)에 걸친 패턴을 찾기 위해 다음 청크와 겹쳐 읽는 꼬리 크기
+PORT_SCAN_MAX_BYTES = int(os.getenv('PORT_SCAN_MAX_BYTES', str(4 * 1024 * 1024)))  # 파일당 최대 검사 크기
+
+def _compile_port_rules(rules):
+    pattern = re.compile(b'|'.join(b'(?P<%s>%s)' % (name.encode(), regex) for name, _, regex in rules))
+    ranks = {name: rank for rank, (name, _, _) in enumerate(rules)}
+    labels = {name: label for name, label, _ in rules}
+    return pattern, ranks, labels
+
+PORT_PATTERNS = {file_name: _compile_port_rules(rules) for file_name, rules in PORT_RULES.items()}
+
+def scan_port_file(file_path, file_name):
+    """
+    파일을 청크 단위로 한 번만 읽으며 'port'가 나오는 위치에서 합쳐진 패턴을 검사하고 (port, label)을 반환합니다.
+    가장 우선순위가 높은 규칙이 맞으면 즉시 중단하고, 아니면 규칙별 첫 매치 중 우선순위가 높은 것을 고릅니다.
+    청크 끝의 PORT_SCAN_OVERLAP 바이트 안에 있는 위치는 다음 청크와 이어 붙인 뒤 검사하므로,
+    'PORT =\\n5000'처럼 줄바꿈을 넘는 패턴도 파일 전체를 검사할 때와 같이 찾습니다.
+    """
+    pattern, ranks, labels = PORT_PATTERNS[file_name]
+    back = max(PORT_ANCHOR_OFFSETS)
+    best = None  # (rank, rule_name, port)
+    try:
+        with open(file_path, 'rb') as f:
+            block = b''
+            start = 0  # 앞 청크에서 이미 검사한 위치는 건너뜀
+            read_total = 0
+            while True:
+                data = f.read(PORT_SCAN_CHUNK)
+                read_total += len(data)
+                final = not data or read_total >= PORT_SCAN_MAX_BYTES
+                block += data
+                limit = len(block) if final else max(start, len(block) - PORT_SCAN_OVERLAP)
+                for anchor in PORT_ANCHOR.finditer(block.lower(), start):
+                    position = anchor.start()
+                    if position >= limit:
+                        break
+                    for offset in PORT_ANCHOR_OFFSETS:
+                        if position < offset:
+                            continue
+                        match = pattern.match(block, position - offset)
+                        if not match:
+                            continue
+                        rule = match.lastgroup
+                        rank = ranks[rule]
+                        if best is None or rank < best[0]:
+                            best = (rank, rule, int(match.group(rule + '_n')))
+                            if rank == 0:
+                                return best[2], labels[rule]
+                        break
+                if final:
+                    break
+                # 검사하지 않은 꼬리와, 그 앞의 '@'/'SERVER_' 보정 거리만큼을 남김
+                keep = max(0, limit - back)
+                block, start = block[keep:], limit - keep
+    except OSError:
+        return None, None
+    if best is None:
+        return None, None
+    return best[2], labels[best[1]]
+
+def detect_project_port(project_path):
+    """
+    프로젝트 폴더에서 포트 정보를 찾아 (port, source)를 반환합니다. 없으면 (None, None).
+    source는 어떤 규칙으로 찾았는지 나타냅니다 (예: '.port', '.env: SERVER_PORT/PORT', 'app.py: app.run(port=...)').
+    규칙:
+    0. .port 파일: 숫자만 (사용자 수동 설정)
+    1. .env 파일: # @port: XXXX 주석, SERVER_PORT=XXXX 또는 PORT=XXXX
+    2. app.py 파일: # @port: XXXX 주석, app.run(port=XXXX), PORT = XXXX, "port": XXXX
+    """
     # 0. .port 파일 확인 (사용자 수동 설정)
     port_file = os.path.join(project_path, '.port')
-    if os.path.exists(port_file):
-        content = read_file_safe(port_file)
-        if content and content.strip().isdigit():
-            return int(content.strip())
-
-    # 1. .env 파일 확인
-    env_file = os.path.join(project_path, '.env')
-    if os.path.exists(env_file):
-        content = read_file_safe(env_file)
-        if content:
-            # @port: XXXX 주석 확인
-            match = re.search(r'@port:\s*(\d+)', content)
-            if match:
-                return int(match.group(1))
-            
-            # 정규표현식으로 직접 찾기 (dotenv_values 대신)
-            match = re.search(r'(?:SERVER_PORT|PORT)\s*=\s*(\d+)', content)
-            if match:
-                return int(match.group(1))
-
-    # 2. app.py 파일 확인
-    app_py = os.path.join(project_path, 'app.py')
-    if os.path.exists(app_py):
-        content = read_file_safe(app_py)
-        if content:
-            # @port: XXXX 주석 확인 (가장 우선순위 높음)
-            match = re.search(r'@port:\s*(\d+)', content)
-            if match:
-                return int(match.group(1))
-            
-            # app.run(port=XXXX) 또는 app.run(..., port=XXXX, ...)
-            match = re.search(r'port\s*=\s*(\d+)', content)
-            if match:
-                return int(match.group(1))
-            
-            # SERVER_PORT = XXXX 또는 PORT = XXXX 패턴 찾기 (int() 감싸기 포함)
-            match = re.search(r'(?:SERVER_PORT|PORT)\s*=\s*(?:int\()?(\d+)', content)
-            if match:
-                return int(match.group(1))
-            
-            # 마지막 수단: 파일 전체에서 "port" 단어 근처의 숫자 찾기
-            # 예: "port": 5000, "port" : 5000 등
-            match = re.search(r'port["\']?\s*[:=]\s*(\d{4,5})', content, re.IGNORECASE)
-            if match:
-                return int(match.group(1))
-    
-    return None
+    try:
+        with open(port_file, 'rb') as f:
+            content = f.read(64).strip()
+        if content.isdigit():
+            return int(content), '.port'
+    except OSError:
+        pass
+
+    # 1. .env 파일, 2. app.py 파일 순서로 확인
+    for file_name in ('.env', 'app.py'):
+        port, label = scan_port_file(os.path.join(project_path, file_name), file_name)
+        if port is not None:
+            return port, f"{file_name}: {label}"
+
+    return None, None
+
+def get_project_port(project_path):
+    """
+    프로젝트 폴더에서 포트 정보를 찾습니다. 규칙은 detect_project_port()를 참고하세요.
+    """
+    return detect_project_port(project_path)[0]
 
 def restart_project_server(project_id):
     """특정 프로젝트의 서버를 재시작합니다."""
@@ -471,10 +1300,8 @@ def get_project_path(project_id):
 @app.route('/api/auth/login', methods=['POST'])
 def api_login():
     """로그인 API 엔드포인트"""
-    global account_locked
-    
     # 계정이 잠겨있는지 확인
-    if account_locked:
+    if is_account_locked():
         return jsonify({
             "success": False,
             "error": "계정이 잠겼습니다. 서버를 재시작해야 합니다.",
@@ -491,7 +1318,7 @@ def api_login():
             "success": False,
             "error": "아이디와 비밀번호를 입력해주세요.",
             "attempts": attempts,
-            "locked": account_locked
+            "locked": is_account_locked()
         }), 400
     
     # 사용자 인증 확인 (해시된 비밀번호 비교)
@@ -507,7 +1334,7 @@ def api_login():
     else:
         # 로그인 실패
         attempts = increment_login_attempts()
-        locked = account_locked
+        locked = is_account_locked()
         
         error_msg = "아이디 또는 비밀번호가 올바르지 않습니다."
         if locked:
@@ -604,7 +1431,7 @@ def api_auth_status():
     return jsonify({
         "authenticated": session.get('authenticated', False),
         "attempts": attempts,
-        "locked": account_locked,
+        "locked": is_account_locked(),
         "remaining": max(0, MAX_LOGIN_ATTEMPTS - attempts),
         "is_admin": is_admin() if session.get('authenticated') else False
     })
@@ -644,6 +1471,36 @@ def api_server_status():
         "is_admin": is_admin()
     })
 
+@app.route('/api/projects/status', methods=['GET'])
+@login_required
+def api_projects_status():
+    """
+    여러 프로젝트의 서버 상태를 한 번에 확인하는 API.
+    ids=a,b,c 로 일부만 요청할 수 있으며, 없으면 모든 프로젝트를 확인합니다.
+    포트 정보는 캐시된 메타데이터를 사용하고 포트 확인은 동시에 수행합니다.
+    """
+    ids = request.args.get('ids')
+    if ids:
+        projects = []
+        for project_id in dict.fromkeys(i.strip() for i in ids.split(',') if i.strip()):
+            project_path = get_project_path(project_id)
+            info = project_cache.get(project_id, project_path) if project_path else None
+            if info:
+                projects.append(info)
+    else:
+        projects = get_projects()
+
+    in_use = check_ports_in_use(project['port'] for project in projects)
+    return jsonify({
+        "projects": [{
+            "project_id": project['id'],
+            "has_server": project['has_server'],
+            "port": project['port'],
+            "port_in_use": in_use.get(project['port'], False)
+        } for project in projects],
+        "is_admin": is_admin()
+    })
+
 @app.route('/api/projects/<project_id>/server/status', methods=['GET'])
 @login_required
 def api_project_server_status(project_id):
@@ -652,16 +1509,15 @@ def api_project_server_status(project_id):
     if not project_path:
         return jsonify({"error": "프로젝트를 찾을 수 없습니다."}), 404
     
-    port = get_project_port(project_path)
+    info = project_cache.get(project_id, project_path)
+    if not info:
+        return jsonify({"error": "프로젝트를 찾을 수 없습니다."}), 404
+    port = info['port']
     port_in_use = is_port_in_use(port) if port else False
     
-    run_server_bat = os.path.join(project_path, 'run_server.bat')
-    restart_server_bat = os.path.join(project_path, 'restart_server.bat')
-    has_server = os.path.exists(run_server_bat) or os.path.exists(restart_server_bat)
-    
     return jsonify({
         "project_id": project_id,
-        "has_server": has_server,
+        "has_server": info['has_server'],
         "port": port,
         "port_in_use": port_in_use,
         "is_admin": is_admin()
@@ -690,6 +1546,17 @@ def api_restart_project_server(project_id):
             "error": f"서버 재시작 중 오류: {str(e)}"
         }), 500
 
+@app.route('/api/commands/refresh', methods=['POST'])
+@admin_required
+def api_refresh_commands():
+    """CLI 명령어 경로 캐시를 비우고 다시 찾습니다 (도구를 새로 설치/제거한 후 사용)."""
+    resolved = refresh_command_cache()
+    return jsonify({
+        "success": True,
+        "commands": resolved,
+        "missing": [name for name, path in resolved.items() if not path]
+    })
+
 @app.route('/api/projects/<project_id>/port', methods=['POST'])
 @login_required
 def set_project_port(project_id):
@@ -708,17 +1575,401 @@ def set_project_port(project_id):
         port_file = os.path.join(project_path, '.port')
         with open(port_file, 'w', encoding='utf-8') as f:
             f.write(str(port))
+        project_cache.invalidate(project_id)
+        if project_registry.mode:
+            project_registry.refresh([project_id])
         return jsonify({"success": True, "message": f"포트가 {port}로 설정되었습니다.", "port": int(port)})
     except Exception as e:
         return jsonify({"error": f"포트 설정 중 오류 발생: {str(e)}"}), 500
 
+# --- Metrics ---
+METRIC_HELP = {
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency by route (until the response body is sent).'),
+    'query_stage_seconds': ('histogram', 'Query latency by stage: rate_wait, context, resolve, spawn, first_byte, db_write, total.'),
+    'queries_total': ('counter', 'Finished queries by outcome: ok, cached, error, cancelled, disconnected, rate_limited.'),
+    'active_queries': ('gauge', 'CLI queries currently running in this process.'),
+    'pending_jobs': ('gauge', 'Background jobs waiting in the queue.'),
+}
+
+class Metrics:
+    """
+    카운터와 히스토그램을 프로세스 메모리에 모아 Prometheus 텍스트 형식(/metrics)과 JSON 요약(/api/metrics)으로 내보냅니다.
+    값은 프로세스별로 유지되므로 serve.py로 워커를 여러 개 띄우면 요청을 받은 워커의 값만 보입니다.
+    """
+
+    def __init__(self, buckets, prefix='remotechat_'):
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        self.histograms = {}  # (name, labels): {"buckets": [...], "sum": float, "count": int}
+        self.counters = {}  # (name, labels): int
+        self.gauges = {}  # name: 값을 반환하는 함수 (조회 시점에 계산)
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def observe(self, name, value, **labels):
+        """히스토그램에 값(초)을 하나 기록합니다."""
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)  # 마지막 칸은 +Inf
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = {"buckets": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series['buckets'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.started = time.time()
+
+    def quantile(self, counts, q):
+        """구간 안에서 선형 보간하여 분위수를 추정합니다 (Prometheus histogram_quantile과 같은 방식)."""
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        # +Inf 구간에 걸리면 가장 큰 유한 경계를 반환
+        return self.buckets[-1]
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {key: {"buckets": list(v['buckets']), "sum": v['sum'], "count": v['count']}
+                          for key, v in self.histograms.items()}
+            counters = dict(self.counters)
+        gauges = {}
+        for name, read in self.gauges.items():
+            try:
+                gauges[name] = read()
+            except Exception:
+                pass
+        return histograms, counters, gauges
+
+    def summary(self):
+        """JSON 요약: 시계열마다 건수, 초당 처리량, 평균과 p50/p95/p99(초)."""
+        histograms, counters, gauges = self.snapshot()
+        uptime = max(time.time() - self.started, 1e-9)
+        result = {"uptimeSeconds": round(uptime, 3), "histograms": {}, "counters": {}, "gauges": gauges}
+        for (name, labels), series in sorted(histograms.items()):
+            count = series['count']
+            entry = dict(labels)
+            entry.update({
+                "count": count,
+                "perSecond": round(count / uptime, 4),
+                "avg": round(series['sum'] / count, 6) if count else None,
+            })
+            for q in (0.5, 0.95, 0.99):
+                value = self.quantile(series['buckets'], q)
+                entry[f"p{int(q * 100)}"] = round(value, 6) if value is not None else None
+            result['histograms'].setdefault(name, []).append(entry)
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].setdefault(name, []).append(dict(labels, value=value))
+        return result
+
+    def render_prometheus(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        histograms, counters, gauges = self.snapshot()
+        lines = []
+        series_by_name = {}
+        for (name, labels), series in histograms.items():
+            series_by_name.setdefault(name, []).append((labels, series))
+        for (name, labels), value in counters.items():
+            series_by_name.setdefault(name, []).append((labels, value))
+        for name, value in gauges.items():
+            series_by_name.setdefault(name, []).append(((), value))
+
+        for name in sorted(series_by_name):
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            full_name = self.prefix + name
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for labels, value in sorted(series_by_name[name], key=lambda item: item[0]):
+                if kind != 'histogram':
+                    lines.append(f"{full_name}{format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), value['buckets']):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f"{full_name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {value['sum']}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    """(name, value) 튜플들을 Prometheus 레이블 문자열로 만듭니다."""
+    if not labels:
+        return ''
+    parts = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{name}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+metrics = Metrics(METRICS_BUCKETS)
+metrics.gauge('active_queries', lambda: len(active_queries.runs))
+metrics.gauge('pending_jobs', lambda: len(job_manager.pending))
+
+class QueryStages:
+    """
+    쿼리 하나의 단계별 소요 시간을 query_stage_seconds에 기록합니다 (backend, project 레이블).
+    - rate_wait: 요청 빈도 제한으로 기다린 시간 / context: 이전 대화 맥락 조립 / resolve: CLI 경로 확인 / spawn: 프로세스 시작(상주 프로세스면 체크아웃)
+    - first_byte: 프로세스 시작부터 첫 출력까지
+    - db_write: history 저장 (save_history에서 기록) / total: 요청 접수부터 끝날 때까지
+    """
+
+    def __init__(self, cli_tool, project_id):
+        self.labels = {"backend": cli_tool, "project": project_id}
+        self.started = time.perf_counter()
+        self.spawn_started = None
+        self.first_byte_seen = False
+        self.finished = False
+
+    def observe(self, stage, seconds):
+        metrics.observe('query_stage_seconds', seconds, stage=stage, **self.labels)
+
+    @contextmanager
+    def measure(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def spawning(self):
+        self.spawn_started = time.perf_counter()
+
+    def spawned(self):
+        if self.spawn_started is not None:
+            self.observe('spawn', time.perf_counter() - self.spawn_started)
+
+    def first_output(self):
+        if not self.first_byte_seen and self.spawn_started is not None:
+            self.first_byte_seen = True
+            self.observe('first_byte', time.perf_counter() - self.spawn_started)
+
+    def output(self, chunks):
+        """chunks를 그대로 전달하면서 첫 조각이 도착한 시각을 기록합니다."""
+        for text in chunks:
+            self.first_output()
+            yield text
+
+    def finish(self, outcome):
+        """쿼리 종료를 기록합니다. 처음 호출만 반영되므로 마지막 안전장치(finally)에서 다시 불러도 됩니다."""
+        if self.finished:
+            return
+        self.finished = True
+        self.observe('total', time.perf_counter() - self.started)
+        metrics.inc('queries_total', outcome=outcome, **self.labels)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """라우트별 요청 지연 시간을 기록합니다. 스트리밍 응답도 본문 전송이 끝난 시점(close)에 기록합니다."""
+    started = g.get('request_started')
+    if started is not None:
+        labels = {
+            "method": request.method,
+            # 경로 대신 라우트 규칙을 써서 시계열 수를 제한 (/api/jobs/<job_id> 등)
+            "route": request.url_rule.rule if request.url_rule else 'unmatched',
+            "status": str(response.status_code),
+        }
+        response.call_on_close(
+            lambda: metrics.observe('http_request_duration_seconds', time.perf_counter() - started, **labels)
+        )
+    return response
+
+def metrics_authorized():
+    """로그인한 세션이거나 METRICS_TOKEN과 일치하는 Bearer 토큰이면 True."""
+    if session.get('authenticated'):
+        return True
+    auth = request.headers.get('Authorization', '')
+    return bool(METRICS_TOKEN) and auth.startswith('Bearer ') and secrets.compare_digest(auth[7:], METRICS_TOKEN)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 수집용 지표 (text exposition format)."""
+    if not metrics_authorized():
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    return Response(metrics.render_prometheus(), mimetype='text/plain', headers={'Cache-Control': 'no-store'})
+
+@app.route('/api/metrics', methods=['GET'])
+def api_metrics():
+    """지표 JSON 요약 (p50/p95/p99, 초당 처리량). reset=1이면 조회 후 초기화합니다 (벤치마크 구간 측정용)."""
+    if not metrics_authorized():
+        return jsonify({"error": "인증이 필요합니다.", "authenticated": False}), 401
+    summary = metrics.summary()
+    if request.args.get('reset') in ('1', 'true'):
+        metrics.reset()
+    return jsonify(summary)
+
+# --- HTTP Caching & Compression ---
+try:
+    import brotli  # 선택 사항: 있으면 br 인코딩도 지원
+except ImportError:
+    brotli = None
+
+# 압축할 응답 형식 (SSE, NDJSON 같은 스트리밍 응답은 압축하면 점진적 전달이 막히므로 제외)
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/css', 'text/plain', 'application/javascript'}
+
+@app.after_request
+def compress_response(response):
+    """COMPRESS_MIN_BYTES 이상인 응답을 클라이언트가 지원하는 인코딩(br > gzip)으로 압축합니다."""
+    if (not COMPRESS_MIN_BYTES or response.status_code != 200 or response.direct_passthrough
+            or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+
+    if brotli and request.accept_encodings['br']:
+        response.set_data(brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=COMPRESS_GZIP_LEVEL, mtime=0))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def conditional_response(version, last_modified, build):
+    """
+    조건부 GET을 처리합니다. version(데이터가 바뀌면 달라지는 값)과 요청 URL, 사용자로 약한 ETag를 만들고,
+    If-None-Match(없으면 If-Modified-Since)가 일치하면 build()를 호출하지 않고 304를 반환합니다.
+    Cache-Control: no-cache로 브라우저가 매번 재검증하므로 바뀐 데이터는 바로 받습니다.
+    """
+    raw = json.dumps([request.full_path, session.get('username'), version], default=str)
+    etag = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    elif last_modified and request.if_modified_since:
+        # HTTP 날짜는 초 단위이므로, 같은 초 안의 두 번째 쓰기를 304로 잘못 판단하지 않도록 다음 초로 올려서 비교
+        modified = last_modified.replace(microsecond=0)
+        if last_modified.microsecond:
+            modified += timedelta(seconds=1)
+        not_modified = modified <= request.if_modified_since
+    else:
+        not_modified = False
+
+    response = Response(status=304) if not_modified else build()
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+def history_version(project_id, session_id=None):
+    """
+    프로젝트(또는 세션)의 마지막 history id와 시각을 반환합니다. history는 추가만 되므로 이 값이 같으면 내용도 같습니다.
+    (projectId, id) / (projectId, sessionId, id) 인덱스에서 한 행만 읽습니다.
+    """
+    sql = 'SELECT id, timestamp FROM history WHERE projectId = ?'
+    params = [project_id]
+    if session_id:
+        sql += ' AND sessionId = ?'
+        params.append(session_id)
+    with db_pool.connection() as conn:
+        row = conn.execute(sql + ' ORDER BY id DESC LIMIT 1', params).fetchone()
+    if not row:
+        return 0, None
+    try:
+        # 저장 시각은 서버 로컬 시간
+        last_modified = datetime.fromisoformat(str(row['timestamp'])).astimezone(timezone.utc)
+    except ValueError:
+        last_modified = None
+    return row['id'], last_modified
+
 # --- API Endpoints ---
 @app.route('/api/projects', methods=['GET'])
 @login_required
 def list_projects():
-    """Returns the list of projects."""
+    """
+    Returns the list of projects.
+    감시가 켜져 있으면 레지스트리 버전으로 ETag를 만들어, 바뀐 것이 없으면 304를 반환합니다.
+    """
+    if project_registry.ensure_started():
+        snapshot = project_registry.snapshot()
+        return conditional_response(snapshot['version'], None, lambda: jsonify(snapshot['projects']))
     projects = get_projects()
-    return jsonify(projects)
+    return conditional_response(projects, None, lambda: jsonify(projects))
+
+@app.route('/api/projects/events', methods=['GET'])
+@login_required
+def project_events():
+    """
+    프로젝트 목록 변경을 SSE로 전달합니다.
+    연결 직후 전체 목록(snapshot)을 보내고, 이후 added/removed/changed 이벤트를 보냅니다.
+    """
+    if not project_registry.ensure_started():
+        return jsonify({"error": "프로젝트 감시가 비활성화되어 있습니다."}), 503
+
+    subscriber = project_registry.subscribe()
+
+    def generate():
+        try:
+            yield sse_event('snapshot', project_registry.snapshot())
+            while True:
+                try:
+                    event, data = subscriber.get(timeout=15)
+                except queue.Empty:
+                    # 프록시가 유휴 연결을 끊지 않도록 주석 줄 전송
+                    yield ": keepalive\n\n"
+                    continue
+                yield sse_event(event, data)
+        finally:
+            project_registry.unsubscribe(subscriber)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/projects/cache/invalidate', methods=['POST'])
+@login_required
+def invalidate_project_cache():
+    """프로젝트 메타데이터 캐시를 비웁니다. projectId를 주면 해당 프로젝트만 비웁니다."""
+    data = request.get_json(silent=True) or {}
+    project_id = data.get('projectId')
+    project_cache.invalidate(project_id)
+    if project_registry.mode:
+        project_registry.refresh([project_id] if project_id else None)
+    return jsonify({"success": True, "projectId": project_id})
+
+@app.route('/api/cache/responses/clear', methods=['POST'])
+@login_required
+def clear_response_cache():
+    """응답 캐시를 모두 비웁니다."""
+    deleted = response_cache.clear()
+    return jsonify({"success": True, "deleted": deleted})
 
 @app.route('/api/select-project', methods=['POST'])
 @login_required
@@ -739,25 +1990,27 @@ def select_project():
     session['selected_project_id'] = project_id
     return jsonify({"message": f"Project '{project_id}' selected."})
 
-@app.route('/api/query', methods=['POST'])
-@login_required
-def handle_query():
+def prepare_query(data):
     """
-    Executes a CLI command in the specified project directory and returns the result.
-    Saves the conversation to the history.
+    쿼리 요청 데이터를 검증하고 실행에 필요한 정보를 dict로 반환합니다.
+    Returns (query, None) on success, otherwise (None, (error_message, status_code)).
     """
     import uuid
-    
-    data = request.json
+
+    data = data or {}
     project_id = data.get('projectId')  # None일 수 있음 (프로젝트 선택 안 함)
     cli_tool = data.get('cli')
     message = data.get('message')
     model = data.get('model') # Gemini 모델 버전
     session_id = data.get('sessionId')
     new_session = data.get('newSession', False)
+    query_id = data.get('queryId')  # 취소(/api/query/<queryId>/cancel)에 사용할 ID, 없으면 생성
 
     if not cli_tool or not message:
-        return jsonify({"error": "Missing cli or message"}), 400
+        return None, ("Missing cli or message", 400)
+    backend = CLI_BACKENDS.get(cli_tool)
+    if not backend:
+        return None, ("Unsupported CLI tool", 400)
 
     # 프로젝트가 선택되지 않았으면 BASE_DIR에서 실행
     if not project_id:
@@ -766,115 +2019,1860 @@ def handle_query():
     else:
         project_path = get_project_path(project_id)
         if not project_path:
-            return jsonify({"error": "Invalid or unauthorized project path"}), 400
-    
-    # 새 세션이면 새 sessionId 생성
+            return None, ("Invalid or unauthorized project path", 400)
+
+    # 새 세션이면 새 sessionId 생성 (이전 대화가 없으므로 맥락도 붙이지 않음)
+    use_context = CONTEXT_HISTORY and data.get('useContext', True) is not False
     if new_session or not session_id:
         session_id = str(uuid.uuid4())
+        use_context = False
+    if not isinstance(query_id, str) or not re.fullmatch(r'[\w-]{1,64}', query_id):
+        query_id = str(uuid.uuid4())
 
-    # Determine the command based on the selected CLI tool
-    # NOTE: These commands are examples. Adjust them if your CLI tools require different arguments.
-    assistant_response = ""
-    if cli_tool == 'echo':
-        # Echo mode for testing without real CLI tools
-        assistant_response = f"Echo: {message}"
+    return {
+        "query_id": query_id,
+        "username": session.get('username'),
+        "project_id": project_id,
+        "project_path": project_path,
+        "cli": cli_tool,
+        "backend": backend,
+        "message": message,
+        "model": model,
+        "session_id": session_id,
+        "no_cache": bool(data.get('noCache')),  # 응답 캐시를 건너뛰고 항상 CLI 실행
+        "use_context": use_context,  # 같은 세션의 이전 대화를 프롬프트 앞에 붙임
+        "stages": QueryStages(cli_tool, project_id)  # 단계별 소요 시간 기록
+    }, None
+
+class QueryError(Exception):
+    """쿼리 실행 실패. API 응답의 error 메시지와 상태 코드를 담습니다."""
+
+    def __init__(self, message, status=500):
+        super().__init__(message)
+        self.status = status
+
+# CLI를 새 프로세스 그룹으로 띄워, 종료할 때 Node CLI가 띄운 손자 프로세스까지 함께 정리합니다.
+if os.name == 'nt':
+    PROCESS_GROUP_KWARGS = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+else:
+    PROCESS_GROUP_KWARGS = {'start_new_session': True}
+
+def kill_process_tree(process):
+    """PROCESS_GROUP_KWARGS로 띄운 프로세스와 그 자손 프로세스를 모두 종료합니다."""
+    if os.name == 'nt':
+        if process.poll() is None:
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
     else:
-        command_name = None
-        if cli_tool == 'gemini':
-            # @google/gemini-cli 패키지는 'gemini' 명령어로 설치됨
-            command_name = 'gemini'
-        elif cli_tool == 'claude':
-            command_name = 'claude'
-        else:
-            return jsonify({"error": "Unsupported CLI tool"}), 400
-        
-        # Find the full path to the command
-        command_path = find_command(command_name)
-        if not command_path:
-            error_msg = (
-                f"Error: The command '{command_name}' was not found. "
-                f"Make sure it is installed and in your system's PATH. "
-                f"If installed via npm, ensure npm's global bin directory is in your PATH."
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    if process.poll() is None:
+        process.kill()
+
+class QueryRun:
+    """
+    실행 중인 쿼리 하나의 프로세스, 제한 시간, 취소 상태를 관리합니다.
+    attach()로 프로세스가 연결되면 timeout 초 뒤에 프로세스 트리를 종료하는 타이머를 시작합니다.
+    """
+
+    def __init__(self, query_id, username, timeout):
+        self.query_id = query_id
+        self.username = username
+        self.timeout = timeout
+        self.process = None
+        self.timer = None
+        self.cancelled = False
+        self.timed_out = False
+        self.lock = threading.Lock()
+
+    def attach(self, process):
+        with self.lock:
+            self.process = process
+            stopped = self.cancelled or self.timed_out
+            if self.timeout and not stopped and not self.timer:
+                self.timer = threading.Timer(self.timeout, self._expire)
+                self.timer.daemon = True
+                self.timer.start()
+        if stopped:
+            kill_process_tree(process)
+
+    def _expire(self):
+        with self.lock:
+            self.timed_out = True
+            process = self.process
+        if process:
+            kill_process_tree(process)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            process = self.process
+        if process:
+            kill_process_tree(process)
+
+    def stop(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+
+    def error(self):
+        """취소되었거나 시간 초과로 중단된 경우 그에 맞는 QueryError를, 아니면 None을 반환합니다."""
+        if self.cancelled:
+            return QueryError("Query was cancelled", 409)
+        if self.timed_out:
+            return QueryError(f"CLI command timed out after {self.timeout:g} seconds", 504)
+        return None
+
+class QueryTracker:
+    """
+    queryId별로 실행 중인 쿼리를 추적하여 브라우저에서 취소할 수 있게 합니다.
+    워커 프로세스가 여러 개(WEB_WORKERS > 1)이면 취소 요청이 다른 워커로 갈 수 있으므로,
+    이 프로세스에 없는 쿼리의 취소는 query_cancellations 테이블에 기록하고 각 워커가 주기적으로 확인합니다.
+    """
+
+    def __init__(self):
+        self.runs = {}  # query_id: QueryRun
+        self.lock = threading.Lock()
+        self.poller = None
+
+    @contextmanager
+    def track(self, query):
+        """
+        쿼리 실행 구간을 등록합니다. 구간 안에서 QueryError가 나면 취소/시간 초과 여부에 맞게 바꿔서 발생시킵니다.
+        """
+        run = QueryRun(query['query_id'], query['username'], query['backend'].timeout)
+        with self.lock:
+            self.runs[run.query_id] = run
+            if WEB_WORKERS > 1 and not self.poller:
+                self.poller = threading.Thread(target=self._poll_cancellations, name="query-cancel-poller", daemon=True)
+                self.poller.start()
+        try:
+            yield run
+        except QueryError as e:
+            raise run.error() or e
+        finally:
+            run.stop()
+            with self.lock:
+                if self.runs.get(run.query_id) is run:
+                    del self.runs[run.query_id]
+
+    def get(self, query_id):
+        with self.lock:
+            return self.runs.get(query_id)
+
+    def cancel(self, query_id, username):
+        """
+        쿼리를 취소합니다. 이 프로세스에서 실행 중이면 바로 종료하고, 아니면 다른 워커가 처리하도록
+        취소 요청을 기록합니다 (워커가 하나뿐이면 기록하지 않음). 취소 요청을 접수했으면 True.
+        """
+        run = self.get(query_id)
+        if run:
+            if run.username != username:
+                return False
+            run.cancel()
+            return True
+        if WEB_WORKERS <= 1:
+            return False
+        with db_pool.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO query_cancellations (query_id, username, created_at) VALUES (?, ?, ?)',
+                (query_id, username, time.time())
             )
-            return jsonify({"error": error_msg}), 500
-        
-        # Build the command with the full path
-        if cli_tool == 'gemini':
-            # Example for Gemini: gemini --model gemini-1.5-flash prompt "your message"
-            command = [command_path]
-            if model:
-                command.extend(["--model", model])
-            command.extend(["prompt", message])
-        elif cli_tool == 'claude':
-            # Example for Claude: claude prompt "your message"
-            command = [command_path, "prompt", message]
-        
+            conn.commit()
+        return True
+
+    def _poll_cancellations(self):
+        while True:
+            time.sleep(CANCEL_POLL_INTERVAL)
+            with self.lock:
+                runs = dict(self.runs)
+            try:
+                with db_pool.connection() as conn:
+                    # 실행이 끝난 쿼리에 대한 오래된 요청은 정리
+                    conn.execute('DELETE FROM query_cancellations WHERE created_at < ?', (time.time() - 60,))
+                    conn.commit()
+                    if not runs:
+                        continue
+                    placeholders = ','.join('?' * len(runs))
+                    rows = conn.execute(
+                        f'SELECT query_id, username FROM query_cancellations WHERE query_id IN ({placeholders})',
+                        list(runs)
+                    ).fetchall()
+                    for row in rows:
+                        run = runs[row['query_id']]
+                        if run.username == row['username']:
+                            run.cancel()
+                    if rows:
+                        conn.executemany('DELETE FROM query_cancellations WHERE query_id = ?',
+                                         [(row['query_id'],) for row in rows])
+                        conn.commit()
+            except sqlite3.Error as e:
+                print(f"Query cancel poller error: {e}")
+
+active_queries = QueryTracker()
+
+def build_cli_command(query):
+    """
+    Builds the argument list for the query's CLI backend.
+    Returns (command, None) on success, otherwise (None, (error_message, status_code)).
+    """
+    backend = query['backend']
+
+    # Find the full path to the command
+    with query['stages'].measure('resolve'):
+        command_path = find_command(backend.command_name)
+    if not command_path:
+        error_msg = (
+            f"Error: The command '{backend.command_name}' was not found. "
+            f"Make sure it is installed and in your system's PATH. "
+            f"If installed via npm, ensure npm's global bin directory is in your PATH."
+        )
+        return None, (error_msg, 500)
+
+    # Build the command with the full path
+    return backend.build_args(command_path, query_prompt(query), query['model']), None
+
+def execute_query(query, command=None, on_spawn=None, slot_acquired=False):
+    """
+    쿼리를 실행하고 응답 텍스트를 반환합니다. 실패하면 QueryError를 발생시킵니다.
+    프로세스가 필요한 백엔드는 동시 실행 슬롯을 얻은 뒤 실행합니다 (slot_acquired면 이미 얻은 상태).
+    실행 중에는 queryId로 취소할 수 있고, 백엔드의 timeout을 넘기면 프로세스 트리를 종료합니다.
+    """
+    backend = query['backend']
+    if backend.handler:
+        # 프로세스 없이 처리하는 백엔드 (echo 등)
+        return backend.handler(query)
+
+    if not slot_acquired:
         try:
-            # Execute the command
-            result = subprocess.run(
-                command,
-                cwd=project_path,
-                capture_output=True,
-                text=True,
-                check=True,  # Raises CalledProcessError for non-zero exit codes
-                encoding='utf-8'
+            backend.acquire()
+        except BackendBusy as e:
+            raise QueryError(str(e), 503)
+    try:
+        with active_queries.track(query) as run:
+            def attach(process):
+                run.attach(process)
+                if on_spawn:
+                    on_spawn(process)
+            return run_query_process(query, command, attach)
+    finally:
+        backend.release()
+
+def run_query_process(query, command, on_spawn):
+    """
+    상주 프로세스 또는 일회성 CLI 프로세스로 쿼리를 실행하고 응답 텍스트를 반환합니다.
+    출력은 도착하는 대로 OutputCapture에 모으므로, 아주 큰 출력도 메모리에는 OUTPUT_MEMORY_LIMIT까지만 올라옵니다.
+    """
+    capture = OutputCapture()
+    try:
+        for text in stream_query_chunks(query, command, on_spawn):
+            capture.write(text)
+    except BaseException:
+        capture.discard()
+        raise
+    return finish_capture(query, capture)
+
+def stream_query_chunks(query, command, on_spawn=None):
+    """
+    CLI 출력을 도착하는 대로 텍스트 조각으로 yield 합니다. 실패하면 QueryError를 발생시킵니다.
+    command가 None이면 상주 프로세스를 쓸 수 없을 때 build_cli_command로 만듭니다.
+    parse_output 적용과 streaming을 지원하지 않는 백엔드의 버퍼링은 호출자가 합니다.
+    호출자가 백엔드 슬롯을 얻은 상태여야 합니다.
+    """
+    import codecs
+
+    stages = query['stages']
+
+    def spawned(process):
+        stages.spawned()
+        if on_spawn:
+            on_spawn(process)
+
+    stages.spawning()
+    warm_chunks = warm_query_chunks(query, on_spawn=spawned)
+    if warm_chunks is not None:
+        # 세션의 상주 프로세스로 전송
+        try:
+            yield from stages.output(warm_chunks)
+        except RuntimeError as e:
+            raise QueryError(str(e))
+        finally:
+            warm_chunks.close()
+        return
+
+    if command is None:
+        command, error = build_cli_command(query)
+        if error:
+            raise QueryError(*error)
+
+    stderr_tail = TailBuffer(OUTPUT_STDERR_TAIL_BYTES)
+    stages.spawning()
+    try:
+        process = subprocess.Popen(
+            command,
+            cwd=query['project_path'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **PROCESS_GROUP_KWARGS
+        )
+    except Exception as e:
+        raise QueryError(str(e))
+    spawned(process)
+
+    # stderr 파이프가 가득 차서 프로세스가 멈추지 않도록 별도 스레드에서 비우고, 마지막 부분만 보관합니다.
+    stderr_thread = threading.Thread(
+        target=lambda: stderr_tail.consume(process.stderr),
+        daemon=True
+    )
+    stderr_thread.start()
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    try:
+        while True:
+            data = process.stdout.read1(4096)
+            if not data:
+                break
+            stages.first_output()
+            text = decoder.decode(data)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+        process.wait()
+        stderr_thread.join()
+    finally:
+        # 클라이언트가 연결을 끊은 경우 CLI 프로세스(와 자식 프로세스)도 정리합니다.
+        kill_process_tree(process)
+        process.wait()
+
+    if process.returncode != 0:
+        raise QueryError(f"CLI command failed with exit code {process.returncode}:\n{stderr_tail.text()}")
+
+def save_history(project_id, session_id, cli_tool, message, assistant_response, output=None):
+    """
+    대화 한 턴을 history 테이블에 저장하고 sessions 요약 테이블을 갱신합니다. 저장한 행의 id를 반환합니다.
+    output은 파일로 넘긴 큰 출력의 참조({"file", "size"})이며, 이때 assistant_response는 미리보기입니다.
+    """
+    now = datetime.now()
+    first_message = message
+    # 메시지가 너무 길면 잘라내기
+    if len(first_message) > SESSION_PREVIEW_LENGTH:
+        first_message = first_message[:SESSION_PREVIEW_LENGTH] + '...'
+
+    with metrics.timer('query_stage_seconds', stage='db_write', backend=cli_tool, project=project_id), \
+            db_pool.connection() as conn:
+        cursor = conn.execute('''
+            INSERT INTO history (projectId, sessionId, timestamp, cli, user_message, assistant_message, output_file, output_size)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (project_id, session_id, now, cli_tool, message, compress_message(assistant_response),
+              output['file'] if output else None, output['size'] if output else None))
+        if HISTORY_FTS:
+            # 같은 트랜잭션에서 검색 인덱스에도 추가
+            conn.execute(
+                'INSERT INTO history_fts (rowid, user_message, assistant_message) VALUES (?, ?, ?)',
+                (cursor.lastrowid, message, assistant_response)
             )
-            assistant_response = result.stdout.strip()
-        except FileNotFoundError:
-            error_msg = f"Error: The command '{command_path}' was not found. This should not happen if find_command() worked correctly."
-            return jsonify({"error": error_msg}), 500
-        except subprocess.CalledProcessError as e:
-            error_msg = f"CLI command failed with exit code {e.returncode}:\n{e.stderr}"
-            return jsonify({"error": error_msg}), 500
+        if session_id:
+            conn.execute('''
+                INSERT INTO sessions (sessionId, projectId, first_message, started_at, last_at, turn_count)
+                VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT (projectId, sessionId) DO UPDATE SET
+                    last_at = excluded.last_at,
+                    turn_count = turn_count + 1
+            ''', (session_id, project_id, first_message, now, now))
+        conn.commit()
+    return cursor.lastrowid
+
+def save_query_history(query, assistant_response):
+    """
+    쿼리 결과를 history에 저장합니다. 큰 출력을 파일로 넘긴 경우 응답에 함께 보낼
+    다운로드 정보(historyId, outputSize, outputUrl)를, 아니면 빈 dict를 반환합니다.
+    """
+    output = query.get('output')
+    history_id = save_history(query['project_id'], query['session_id'], query['cli'], query['message'],
+                              assistant_response, output=output)
+    if not output:
+        return {}
+    return {"historyId": history_id, "outputSize": output['size'], "outputUrl": f"/api/history/{history_id}/output"}
+
+def sse_event(event, data):
+    """Server-Sent Events 형식의 메시지 문자열을 만듭니다."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# --- CLI Output Capture ---
+class TailBuffer:
+    """마지막 max_bytes 바이트만 보관하는 링 버퍼입니다 (stderr 오류 메시지용)."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.chunks = deque()
+        self.size = 0
+        self.truncated = False
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        while self.size - len(self.chunks[0]) >= self.max_bytes:
+            self.size -= len(self.chunks.popleft())
+            self.truncated = True
+
+    def consume(self, stream):
+        """stream을 끝까지 읽으면서 마지막 부분만 보관합니다."""
+        for data in iter(lambda: stream.read(8192), b''):
+            self.append(data)
+
+    def text(self):
+        data = b''.join(self.chunks)[-self.max_bytes:]
+        text = data.decode('utf-8', errors='replace')
+        return f"...(truncated)\n{text}" if self.truncated or self.size > self.max_bytes else text
+
+class OutputCapture:
+    """
+    CLI 출력을 모읍니다. memory_limit 바이트까지는 메모리에 두고, 넘으면 지금까지의 내용과 이후 출력을
+    OUTPUT_DIR의 파일에 씁니다. 파일로 넘긴 뒤에는 앞부분 미리보기만 메모리에 남으므로
+    출력 크기와 관계없이 요청당 메모리 사용량이 제한됩니다.
+    """
+
+    def __init__(self, memory_limit=None, preview_chars=None):
+        self.memory_limit = OUTPUT_MEMORY_LIMIT if memory_limit is None else memory_limit
+        self.preview_chars = OUTPUT_PREVIEW_CHARS if preview_chars is None else preview_chars
+        self.parts = []
+        self.size = 0  # 전체 출력 크기(UTF-8 바이트)
+        self.file = None
+        self.path = None
+        self.preview = ''
+
+    @property
+    def spilled(self):
+        return self.path is not None
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.size += len(data)
+        if self.file:
+            self.file.write(data)
+            return
+        self.parts.append(text)
+        if self.memory_limit and self.size > self.memory_limit:
+            self._spill()
+
+    def _spill(self):
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix='output-', suffix='.txt', dir=OUTPUT_DIR)
+        self.file = os.fdopen(fd, 'wb')
+        text = ''.join(self.parts)
+        self.parts = None
+        self.preview = text[:self.preview_chars]
+        self.file.write(text.encode('utf-8'))
+
+    def getvalue(self):
+        """메모리에 모은 출력 전체 (파일로 넘기지 않은 경우)."""
+        return ''.join(self.parts)
+
+    def close(self):
+        """파일을 닫고 history에 저장할 참조({"file", "size"})를 반환합니다."""
+        self.file.close()
+        return {"file": os.path.basename(self.path), "size": self.size}
+
+    def discard(self):
+        """실패하거나 취소된 실행의 임시 파일을 지웁니다."""
+        if self.file:
+            self.file.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+def finish_capture(query, capture):
+    """
+    모은 출력으로 응답 텍스트를 만듭니다. 파일로 넘긴 출력이면 query['output']에 참조를 남기고
+    parse_output 대신 앞부분 미리보기와 안내 문구를 반환합니다 (전체는 /api/history/<id>/output).
+    """
+    if not capture.spilled:
+        return query['backend'].parse_output(capture.getvalue())
+    query['output'] = capture.close()
+    return (
+        f"{capture.preview}\n\n"
+        f"[출력이 {capture.size:,} 바이트로 너무 커서 앞부분 {len(capture.preview):,}자만 표시합니다. 전체 출력은 다운로드하세요.]"
+    )
+
+def output_path(file_name):
+    """history.output_file 값을 OUTPUT_DIR 안의 경로로 바꿉니다. 형식이 맞지 않으면 None."""
+    if not file_name or not re.fullmatch(r'output-[\w]+\.txt', file_name):
+        return None
+    return os.path.join(OUTPUT_DIR, file_name)
+
+# --- Conversation Context ---
+CONTEXT_HEADER = "Previous conversation in this session (oldest first):\n"
+CONTEXT_SUMMARY_HEADER = "Earlier turns (summarized):\n"
+CONTEXT_MESSAGE_HEADER = "\n\nCurrent message:\n"
+
+def shorten(text, limit):
+    """공백을 한 칸으로 줄이고 limit 글자를 넘으면 잘라냅니다."""
+    text = ' '.join((text or '').split())
+    return text if len(text) <= limit else text[:max(limit - 1, 0)] + '…'
+
+class ConversationContext:
+    """
+    세션의 이전 대화를 CLI 프롬프트 앞에 붙일 맥락 문자열로 만듭니다.
+    최근 턴부터 원문 그대로 max_chars 안에 담고, 원문이 들어가지 않는 오래된 턴은 한 줄 요약으로 넣습니다.
+    세션별로 읽어 둔 턴(요약 포함)과 조립한 맥락을 LRU로 보관하여, 다음 턴에는 새로 추가된 행만 읽습니다
+    (history는 추가만 되므로 마지막으로 읽은 id 이후만 확인하면 됩니다).
+    """
+
+    def __init__(self, max_chars, max_turns, summary_chars, max_sessions):
+        self.max_chars = max_chars
+        self.max_turns = max(1, max_turns)
+        self.summary_chars = summary_chars
+        self.max_sessions = max(1, max_sessions)
+        self.sessions = OrderedDict()  # (projectId, sessionId): {"last_id", "turns", "prefix"}
+        self.lock = threading.Lock()
+
+    def prefix(self, project_id, session_id):
+        """세션의 맥락 문자열을 반환합니다. 이전 대화가 없으면 빈 문자열."""
+        key = (project_id, session_id)
+        with self.lock:
+            entry = self.sessions.get(key)
+            if entry:
+                self.sessions.move_to_end(key)
+        last_id = entry['last_id'] if entry else 0
+
+        # 새로 추가된 턴만 읽음 ((projectId, sessionId, id) 인덱스). 처음이면 최근 max_turns 개만
+        with db_pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT id, user_message, decompress_message(assistant_message) AS assistant_message
+                FROM history WHERE projectId = ? AND sessionId = ? AND id > ?
+                ORDER BY id DESC LIMIT ?
+            ''', (project_id, session_id, last_id, self.max_turns)).fetchall()
+        if not rows:
+            return entry['prefix'] if entry else ''
+
+        turns = (entry['turns'] if entry else []) + [self._turn(row) for row in reversed(rows)]
+        turns = turns[-self.max_turns:]
+        entry = {"last_id": turns[-1]['id'], "turns": turns, "prefix": self._assemble(turns)}
+        with self.lock:
+            self.sessions[key] = entry
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return entry['prefix']
+
+    def _turn(self, row):
+        user, assistant = row['user_message'] or '', row['assistant_message'] or ''
+        return {
+            "id": row['id'],
+            "text": f"User: {user}\nAssistant: {assistant}",
+            # 요약은 턴을 읽을 때 한 번만 만들어 보관
+            "summary": f"- User: {shorten(user, self.summary_chars)} / Assistant: {shorten(assistant, self.summary_chars)}",
+        }
+
+    def _assemble(self, turns):
+        budget = self.max_chars - len(CONTEXT_HEADER) - len(CONTEXT_SUMMARY_HEADER)
+        recent, summaries = [], []
+        for turn in reversed(turns):
+            # 최근 턴부터 원문으로, 원문이 들어가지 않는 턴부터는 요약으로
+            if not summaries and len(turn['text']) + 2 <= budget:
+                recent.append(turn['text'])
+                budget -= len(turn['text']) + 2
+            elif len(turn['summary']) + 1 <= budget:
+                summaries.append(turn['summary'])
+                budget -= len(turn['summary']) + 1
+            else:
+                break
+        if not recent and not summaries:
+            return ''
+        parts = [CONTEXT_HEADER]
+        if summaries:
+            parts.append(CONTEXT_SUMMARY_HEADER + '\n'.join(reversed(summaries)) + '\n\n')
+        parts.append('\n\n'.join(reversed(recent)))
+        return ''.join(parts).rstrip()
+
+    def clear(self):
+        with self.lock:
+            self.sessions.clear()
+
+conversation_context = ConversationContext(CONTEXT_MAX_CHARS, CONTEXT_MAX_TURNS, CONTEXT_SUMMARY_CHARS, CONTEXT_CACHE_SESSIONS)
+
+def query_prompt(query):
+    """
+    CLI에 보낼 프롬프트를 반환합니다. 맥락을 쓰는 쿼리는 같은 세션의 이전 대화를 메시지 앞에 붙입니다.
+    한 번 만든 프롬프트는 query에 보관하여 캐시 키 계산과 실행에서 다시 조립하지 않습니다.
+    """
+    if 'prompt' not in query:
+        prefix = ''
+        if query.get('use_context'):
+            with query['stages'].measure('context'):
+                prefix = conversation_context.prefix(query['project_id'], query['session_id'])
+        query['prompt'] = f"{prefix}{CONTEXT_MESSAGE_HEADER}{query['message']}" if prefix else query['message']
+    return query['prompt']
+
+# --- Response Cache ---
+# 지문 계산에서 제외할 폴더 (의존성, 빌드 결과물 등 질문 내용과 무관하고 파일이 많은 곳)
+FINGERPRINT_SKIP_DIRS = {'.git', 'node_modules', '__pycache__', '.venv', 'venv', 'env', 'dist', 'build', '.next', '.cache', '.idea', '.vscode'}
+
+class ProjectFingerprints:
+    """
+    프로젝트 파일 트리의 (상대 경로, mtime, size)를 해시한 지문을 계산합니다. 파일 내용은 읽지 않습니다.
+    같은 프로젝트의 지문은 RESPONSE_CACHE_FINGERPRINT_TTL 동안 재사용하므로 연속된 캐시 조회는 트리를 다시 훑지 않습니다.
+    파일이 RESPONSE_CACHE_MAX_FILES개를 넘는 트리는 None(캐시하지 않음)을 반환합니다.
+    """
+
+    def __init__(self):
+        self.entries = {}  # project_path: (computed_at, fingerprint)
+        self.lock = threading.Lock()
+
+    def get(self, project_path, fresh=False):
+        now = time.time()
+        if not fresh:
+            with self.lock:
+                cached = self.entries.get(project_path)
+            if cached and now - cached[0] < RESPONSE_CACHE_FINGERPRINT_TTL:
+                return cached[1]
+        fingerprint = self._compute(project_path)
+        with self.lock:
+            self.entries[project_path] = (now, fingerprint)
+        return fingerprint
+
+    @staticmethod
+    def _compute(project_path):
+        digest = hashlib.blake2b(digest_size=16)
+        count = 0
+        stack = [project_path]
+        try:
+            while stack:
+                directory = stack.pop()
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=lambda entry: entry.name)
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in FINGERPRINT_SKIP_DIRS:
+                            stack.append(entry.path)
+                        continue
+                    count += 1
+                    if count > RESPONSE_CACHE_MAX_FILES:
+                        return None
+                    stat = entry.stat(follow_symlinks=False)
+                    digest.update(f"{entry.path}\0{stat.st_mtime_ns}\0{stat.st_size}\n".encode('utf-8', 'surrogateescape'))
+            # 커밋/체크아웃은 .git/HEAD, .git/index의 변경으로 반영
+            for name in ('HEAD', 'index'):
+                try:
+                    stat = os.stat(os.path.join(project_path, '.git', name))
+                except OSError:
+                    continue
+                digest.update(f".git/{name}\0{stat.st_mtime_ns}\0{stat.st_size}\n".encode())
+        except OSError:
+            return None
+        return digest.hexdigest()
+
+project_fingerprints = ProjectFingerprints()
+
+class ResponseCache:
+    """
+    같은 질문(cli, model, 맥락을 붙인 프롬프트)을 내용이 바뀌지 않은 프로젝트에 다시 보낼 때 CLI를 다시 실행하지 않도록 응답을 캐시합니다.
+    최근 항목은 메모리 LRU에, 전체는 SQLite response_cache 테이블에 보관합니다.
+    ttl이 지난 항목은 무시하고, 디스크 캐시가 max_bytes를 넘으면 가장 오래 쓰이지 않은 항목부터 지웁니다.
+    """
+
+    def __init__(self, memory_entries, max_bytes, ttl):
+        self.memory_entries = max(1, memory_entries)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.memory = OrderedDict()  # key: (created_at, response)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def cacheable(query):
+        """
+        캐시 대상인지 확인합니다. 프로세스 없이 처리하는 백엔드와,
+        대화 맥락이 상주 프로세스에 남는 세션(같은 질문이라도 답이 달라짐)은 제외합니다.
+        """
+        backend = query['backend']
+        if not RESPONSE_CACHE or query.get('no_cache') or backend.handler:
+            return False
+        return not (CLI_WARM_WORKERS and backend.warm_protocol)
+
+    @staticmethod
+    def key(query, fresh=False):
+        """쿼리의 캐시 키를 반환합니다. 프로젝트 지문을 만들 수 없으면 None."""
+        fingerprint = project_fingerprints.get(query['project_path'], fresh=fresh)
+        if fingerprint is None:
+            return None
+        # 맥락이 붙은 프롬프트로 키를 만들어, 이전 대화가 다른 세션끼리는 응답을 공유하지 않음
+        raw = json.dumps([query['cli'], query['model'], query_prompt(query), query['project_id'], fingerprint])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self.memory.move_to_end(key)
+                return entry[1]
+        with db_pool.connection() as conn:
+            row = conn.execute(
+                'SELECT response, created_at FROM response_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if not row or now - row['created_at'] >= self.ttl:
+                return None
+            conn.execute('UPDATE response_cache SET last_used = ? WHERE key = ?', (now, key))
+            conn.commit()
+        self._remember(key, row['created_at'], row['response'])
+        return row['response']
+
+    def put(self, key, response):
+        now = time.time()
+        self._remember(key, now, response)
+        size = len(response.encode('utf-8'))
+        with db_pool.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO response_cache (key, response, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+                (key, response, size, now, now)
+            )
+            conn.execute('DELETE FROM response_cache WHERE created_at < ?', (now - self.ttl,))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+            if total > self.max_bytes:
+                # 가장 오래 쓰이지 않은 항목부터 크기 제한 안으로 들어올 때까지 삭제
+                evicted = []
+                for row in conn.execute('SELECT key, size FROM response_cache ORDER BY last_used'):
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append((row['key'],))
+                    total -= row['size']
+                conn.executemany('DELETE FROM response_cache WHERE key = ?', evicted)
+            conn.commit()
+
+    def _remember(self, key, created_at, response):
+        with self.lock:
+            self.memory[key] = (created_at, response)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_entries:
+                self.memory.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        with db_pool.connection() as conn:
+            deleted = conn.execute('DELETE FROM response_cache').rowcount
+            conn.commit()
+        return deleted
+
+response_cache = ResponseCache(RESPONSE_CACHE_MEMORY_ENTRIES, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+
+def cached_response(query):
+    """
+    캐시된 응답을 찾습니다. Returns (response, key): 캐시에 없으면 response가 None이고,
+    캐시 대상이 아니면 key도 None입니다.
+    """
+    if not response_cache.cacheable(query):
+        return None, None
+    key = response_cache.key(query)
+    if key is None:
+        return None, None
+    return response_cache.get(key), key
+
+def store_cached_response(query, key, response):
+    """
+    응답을 캐시에 저장합니다. CLI가 실행 중에 프로젝트 파일을 바꿨다면(지문이 달라졌다면)
+    읽기 전용 질문이 아니므로 저장하지 않습니다.
+    """
+    if key is None or query.get('output') or response_cache.key(query, fresh=True) != key:
+        # 파일로 넘긴 큰 출력은 캐시하지 않음
+        return
+    try:
+        response_cache.put(key, response)
+    except sqlite3.Error as e:
+        print(f"Response cache write failed: {e}")
+
+# --- Warm CLI Workers ---
+class StreamJsonProtocol:
+    """
+    claude -p --input-format stream-json --output-format stream-json 대화 프로토콜.
+    stdin으로 한 줄에 하나의 user 메시지를 보내고, stdout의 JSON 이벤트를 읽다가 result 이벤트에서 턴을 끝냅니다.
+    """
+
+    @staticmethod
+    def build_command(command_path, model=None):
+        command = [command_path, '-p', '--input-format', 'stream-json', '--output-format', 'stream-json', '--verbose']
+        if model:
+            command.extend(['--model', model])
+        return command
+
+    @staticmethod
+    def encode(message):
+        payload = {"type": "user", "message": {"role": "user", "content": [{"type": "text", "text": message}]}}
+        return (json.dumps(payload, ensure_ascii=False) + '\n').encode('utf-8')
+
+    @staticmethod
+    def parse(line):
+        """stdout 한 줄을 해석하여 (text, done, error)를 반환합니다."""
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return None, False, None
+        if event.get('type') == 'assistant':
+            content = event.get('message', {}).get('content', [])
+            text = ''.join(part.get('text', '') for part in content if part.get('type') == 'text')
+            return text or None, False, None
+        if event.get('type') == 'result':
+            if event.get('is_error'):
+                return None, True, event.get('result') or "CLI reported an error"
+            return None, True, None
+        return None, False, None
+
+class WarmProcess:
+    """한 세션 전용으로 유지되는 CLI 프로세스. 한 번에 한 턴만 처리합니다."""
+
+    def __init__(self, command, cwd, protocol):
+        self.protocol = protocol
+        self.process = subprocess.Popen(
+            command,
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **PROCESS_GROUP_KWARGS
+        )
+        self.busy = False
+        self.last_used = time.time()
+        self.turns = 0  # 처리한 턴 수 (0이면 아직 대화 맥락이 없는 새 프로세스)
+        # 오류 메시지용으로 stderr의 마지막 몇 줄만 보관
+        self.stderr_tail = deque(maxlen=20)
+        threading.Thread(target=self._drain_stderr, daemon=True).start()
+
+    def _drain_stderr(self):
+        for line in iter(self.process.stderr.readline, b''):
+            self.stderr_tail.append(line.decode('utf-8', errors='replace'))
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def ask(self, message):
+        """메시지를 보내고 응답 텍스트 조각을 yield 합니다. 실패 시 RuntimeError를 발생시킵니다."""
+        self.process.stdin.write(self.protocol.encode(message))
+        self.process.stdin.flush()
+        first = True
+        for line in iter(self.process.stdout.readline, b''):
+            text, done, error = self.protocol.parse(line)
+            if text:
+                # 도구 호출 사이에 여러 assistant 메시지가 올 수 있으므로 문단으로 구분
+                yield text if first else '\n\n' + text
+                first = False
+            if error:
+                raise RuntimeError(error)
+            if done:
+                return
+        raise RuntimeError(f"CLI worker exited unexpectedly:\n{''.join(self.stderr_tail)}")
+
+    def close(self):
+        kill_process_tree(self.process)
+        self.process.wait()
+
+class WarmProcessPool:
+    """
+    (projectId, sessionId, cli) 별로 상주 CLI 프로세스를 유지합니다.
+    같은 세션의 메시지는 같은 프로세스로 보내므로 대화 맥락이 프로세스 안에 유지되고 매번의 기동 비용이 사라집니다.
+    프로세스 수가 max_processes에 도달하면 가장 오래 쉬고 있는 프로세스를 종료하고,
+    idle_timeout 동안 쓰이지 않은 프로세스는 정리 스레드가 종료합니다.
+    """
+
+    def __init__(self, max_processes, idle_timeout):
+        self.max_processes = max(1, max_processes)
+        self.idle_timeout = idle_timeout
+        self.processes = {}  # key: WarmProcess
+        self.lock = threading.Lock()
+        self.reaper = None
+
+    def _ensure_reaper(self):
+        if self.reaper:
+            return
+        self.reaper = threading.Thread(target=self._reap_loop, name="warm-cli-reaper", daemon=True)
+        self.reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(min(30, max(1, self.idle_timeout / 2)))
+            now = time.time()
+            with self.lock:
+                expired = [
+                    key for key, worker in self.processes.items()
+                    if not worker.busy and (now - worker.last_used > self.idle_timeout or not worker.alive())
+                ]
+                workers = [self.processes.pop(key) for key in expired]
+            for worker in workers:
+                worker.close()
+
+    def checkout(self, key, command, cwd, protocol):
+        """
+        세션용 프로세스를 빌립니다. 없으면 새로 띄웁니다.
+        같은 세션의 이전 턴이 아직 실행 중이거나 여유가 없으면 None을 반환합니다 (일회성 실행으로 대체).
+        """
+        evicted = None
+        with self.lock:
+            worker = self.processes.get(key)
+            if worker and not worker.alive():
+                del self.processes[key]
+                worker = None
+            if worker:
+                if worker.busy:
+                    return None
+                worker.busy = True
+                return worker
+
+            if len(self.processes) >= self.max_processes:
+                idle = [(w.last_used, k) for k, w in self.processes.items() if not w.busy]
+                if not idle:
+                    return None
+                evicted = self.processes.pop(min(idle)[1])
+
+            worker = WarmProcess(command, cwd, protocol)
+            worker.busy = True
+            self.processes[key] = worker
+            self._ensure_reaper()
+
+        if evicted:
+            evicted.close()
+        return worker
+
+    def checkin(self, key, worker, healthy):
+        """턴이 끝난 프로세스를 반납합니다. 실패했거나 중단된 턴이면 프로세스를 버립니다."""
+        with self.lock:
+            worker.busy = False
+            worker.last_used = time.time()
+            if healthy and worker.alive():
+                return
+            if self.processes.get(key) is worker:
+                del self.processes[key]
+        worker.close()
+
+warm_pool = WarmProcessPool(per_worker(CLI_WARM_MAX_PROCESSES), CLI_WARM_IDLE_TIMEOUT)
+
+def warm_query_chunks(query, on_spawn=None):
+    """
+    상주 프로세스로 쿼리를 처리할 수 있으면 응답 조각 generator를, 아니면 None을 반환합니다.
+    generator는 실패 시 RuntimeError를 발생시키며, 끝까지 소비되지 않고 닫히면 프로세스를 버립니다.
+    """
+    protocol = query['backend'].warm_protocol
+    if not CLI_WARM_WORKERS or not protocol:
+        return None
+    command_path = find_command(query['backend'].command_name)
+    if not command_path:
+        return None
+
+    key = (query['project_id'], query['session_id'], query['cli'])
+    try:
+        worker = warm_pool.checkout(key, protocol.build_command(command_path, query['model']),
+                                    query['project_path'], protocol)
+    except OSError as e:
+        print(f"Warm CLI worker start failed: {e}")
+        return None
+    if not worker:
+        return None
+    # generator를 만들기 전에 실패하면 finally의 checkin이 실행되지 않으므로 여기서 반납 (프로세스는 버림)
+    try:
+        if on_spawn:
+            on_spawn(worker.process)
+        # 새로 띄운 프로세스에는 세션의 이전 대화를 붙여 보내고, 이후 턴은 프로세스가 맥락을 유지하므로 메시지만 보냄
+        message = query['message'] if worker.turns else query_prompt(query)
+    except BaseException:
+        warm_pool.checkin(key, worker, False)
+        raise
+
+    def generate():
+        healthy = False
+        try:
+            yield from worker.ask(message)
+            worker.turns += 1
+            healthy = True
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f"CLI worker error: {e}")
+        finally:
+            warm_pool.checkin(key, worker, healthy)
+
+    return generate()
+
+# --- CLI Backends ---
+BACKEND_WAIT_TIMEOUT = float(os.getenv('BACKEND_WAIT_TIMEOUT', '30'))  # 백엔드 동시 실행 슬롯 대기 시간(초)
+
+class BackendBusy(Exception):
+    """백엔드의 동시 실행 제한 때문에 BACKEND_WAIT_TIMEOUT 안에 슬롯을 얻지 못한 경우"""
+
+def env_limit(name, default):
+    """환경 변수에서 제한 값을 읽습니다. 0 이하이면 제한 없음(None)입니다."""
+    value = os.getenv(name)
+    if value is None or not value.strip():
+        return default
+    value = float(value)
+    return value if value > 0 else None
+
+class CliBackend:
+    """
+    /api/query에서 사용할 수 있는 CLI 백엔드 정의입니다.
+    - command_name: 실행할 명령어 (handler가 있으면 프로세스 없이 처리)
+    - build_args(command_path, message, model): 명령 인자 목록을 만드는 함수
+    - handler(query): 프로세스 없이 응답을 만드는 함수 (echo 등)
+    - streaming: stdout을 도착하는 대로 전달할 수 있는지 (False면 종료 후 한 번에 전달)
+    - max_concurrency: 동시에 실행할 수 있는 최대 개수 (None이면 제한 없음)
+    - timeout: 실행 제한 시간(초, None이면 제한 없음)
+    - parse_output(stdout): CLI 출력을 응답 텍스트로 변환하는 함수
+    - warm_protocol: 상주 프로세스 프로토콜 (지원하지 않으면 None)
+    max_concurrency와 timeout은 CLI_<NAME>_MAX_CONCURRENCY, CLI_<NAME>_TIMEOUT 환경 변수로 바꿀 수 있습니다.
+    max_concurrency는 서버 전체 기준이며, WEB_WORKERS개의 워커가 나눠 가집니다 (per_worker).
+    """
+
+    def __init__(self, name, command_name=None, build_args=None, handler=None, streaming=True,
+                 max_concurrency=None, timeout=None, parse_output=None, warm_protocol=None):
+        env_prefix = 'CLI_' + re.sub(r'\W', '_', name).upper()
+        self.name = name
+        self.command_name = command_name
+        self.build_args = build_args
+        self.handler = handler
+        self.streaming = streaming
+        max_concurrency = env_limit(f'{env_prefix}_MAX_CONCURRENCY', max_concurrency)
+        self.max_concurrency = per_worker(max_concurrency) if max_concurrency else None
+        self.timeout = env_limit(f'{env_prefix}_TIMEOUT', timeout)
+        self.parse_output = parse_output or (lambda output: output.strip())
+        self.warm_protocol = warm_protocol
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def try_acquire(self):
+        """동시 실행 슬롯을 기다리지 않고 얻습니다. 여유가 없으면 False."""
+        with self.condition:
+            if self.max_concurrency is not None and self.running >= self.max_concurrency:
+                return False
+            self.running += 1
+            return True
+
+    def acquire(self, timeout=None):
+        """동시 실행 슬롯을 얻을 때까지 기다립니다. 시간 안에 못 얻으면 BackendBusy를 발생시킵니다."""
+        timeout = BACKEND_WAIT_TIMEOUT if timeout is None else timeout
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.max_concurrency is not None and self.running >= self.max_concurrency:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise self.busy_error()
+                self.condition.wait(remaining)
+            self.running += 1
+
+    def busy_error(self):
+        return BackendBusy(f"'{self.name}' 백엔드가 사용 중입니다 (동시 실행 {self.max_concurrency}개). 잠시 후 다시 시도해주세요.")
+
+    def release(self):
+        with self.condition:
+            self.running -= 1
+            self.condition.notify()
+
+    def describe(self):
+        return {
+            "name": self.name,
+            "command": self.command_name,
+            "available": bool(self.handler) or bool(find_command(self.command_name)),
+            "streaming": self.streaming,
+            "max_concurrency": self.max_concurrency,
+            "timeout": self.timeout,
+            "running": self.running,
+            "warm": bool(self.warm_protocol) and CLI_WARM_WORKERS
+        }
+
+CLI_BACKENDS = {}  # 이름: CliBackend
+
+def register_backend(backend):
+    """백엔드를 등록합니다. 같은 이름이 있으면 교체합니다."""
+    CLI_BACKENDS[backend.name] = backend
+    return backend
+
+# NOTE: These commands are examples. Adjust them if your CLI tools require different arguments.
+def gemini_args(command_path, message, model):
+    # Example for Gemini: gemini --model gemini-1.5-flash prompt "your message"
+    command = [command_path]
+    if model:
+        command.extend(["--model", model])
+    command.extend(["prompt", message])
+    return command
+
+def claude_args(command_path, message, model):
+    # Example for Claude: claude prompt "your message"
+    return [command_path, "prompt", message]
+
+# 네트워크 없이 동작하는 모의 모델: 단어 단위로 지연을 두고 출력하여 스트리밍/부하 테스트에 사용
+MOCK_MODEL_SCRIPT = (
+    "import sys, time\n"
+    "delay = float(sys.argv[2])\n"
+    "for word in ('Mock response: ' + sys.argv[1]).split(' '):\n"
+    "    sys.stdout.write(word + ' ')\n"
+    "    sys.stdout.flush()\n"
+    "    time.sleep(delay)\n"
+)
+
+def mock_args(command_path, message, model):
+    return [command_path, "-c", MOCK_MODEL_SCRIPT, message, os.getenv('CLI_MOCK_DELAY', '0.05')]
+
+register_backend(CliBackend(
+    'echo',
+    # Echo mode for testing without real CLI tools
+    handler=lambda query: f"Echo: {query['message']}"
+))
+register_backend(CliBackend(
+    'gemini',
+    # @google/gemini-cli 패키지는 'gemini' 명령어로 설치됨
+    command_name='gemini',
+    build_args=gemini_args,
+    max_concurrency=4,
+    timeout=600
+))
+register_backend(CliBackend(
+    'claude',
+    command_name='claude',
+    build_args=claude_args,
+    max_concurrency=4,
+    timeout=600,
+    warm_protocol=StreamJsonProtocol
+))
+register_backend(CliBackend(
+    'mock',
+    command_name=sys.executable,
+    build_args=mock_args,
+    max_concurrency=8,
+    timeout=60
+))
+
+# --- Rate Limiting ---
+class RateLimited(Exception):
+    """토큰 버킷이 비어 있어 거절된 쿼리. retry_after초 뒤에는 기다리지 않고 실행할 수 있습니다."""
+
+    def __init__(self, retry_after):
+        super().__init__("요청이 너무 많습니다. 잠시 후 다시 시도해주세요.")
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+class TokenBucketLimiter:
+    """
+    사용자별, 프로젝트별 토큰 버킷으로 CLI 실행 빈도를 제한합니다.
+    버킷은 burst개까지 쌓이고 초당 rate개씩 채워지며, 쿼리 하나가 두 버킷에서 토큰을 하나씩 씁니다.
+    토큰이 없으면 다음 토큰을 예약하고(잔량이 음수가 됨) 그 시간만큼 기다렸다가 실행하므로,
+    같은 버킷의 요청은 도착 순서대로 처리되고 다른 사용자의 요청은 영향을 받지 않습니다.
+    기다릴 시간이 max_wait를 넘으면 예약하지 않고 RateLimited를 발생시킵니다.
+    버킷 상태는 rate_limits 테이블에 있으므로 serve.py의 모든 워커가 같은 한도를 공유합니다.
+    """
+
+    def __init__(self, limits, max_wait):
+        # kind: (burst, rate). burst나 rate가 0 이하인 버킷은 사용하지 않음
+        self.limits = {kind: limit for kind, limit in limits.items() if limit[0] > 0 and limit[1] > 0}
+        self.max_wait = max(0.0, max_wait)
+
+    def applies(self, query):
+        """프로세스 없이 처리하는 백엔드(echo 등)는 제한하지 않습니다."""
+        return RATE_LIMIT and bool(self.limits) and not query['backend'].handler
+
+    def _buckets(self, query):
+        """쿼리가 쓰는 버킷 목록 [(key, burst, rate)]"""
+        keys = {"user": query['username'] or '', "project": query['project_id']}
+        return [(f"{kind}:{keys[kind]}", burst, rate) for kind, (burst, rate) in self.limits.items()]
+
+    def reserve(self, query, max_wait=None):
+        """쿼리의 토큰을 예약하고 실행 전에 기다려야 할 시간(초)을 반환합니다."""
+        max_wait = self.max_wait if max_wait is None else max_wait
+        buckets = self._buckets(query)
+        now = time.time()
+
+        with db_pool.connection() as conn:
+            # 여러 워커가 같은 버킷을 동시에 쓰지 않도록 쓰기 잠금을 먼저 잡음
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                wait = 0.0
+                updates = []
+                for key, burst, rate in buckets:
+                    row = conn.execute('SELECT tokens, updated_at FROM rate_limits WHERE key = ?', (key,)).fetchone()
+                    tokens = burst if row is None else min(burst, row['tokens'] + (now - row['updated_at']) * rate)
+                    if tokens < 1:
+                        wait = max(wait, (1 - tokens) / rate)
+                    updates.append((key, tokens - 1, now))
+                if wait > max_wait:
+                    raise RateLimited(wait)
+                conn.executemany('''
+                    INSERT INTO rate_limits (key, tokens, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+                ''', updates)
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+        return wait
+
+    def schedule(self, query, max_wait=None):
+        """
+        제한 대상이면 토큰을 예약하고 실행 전에 기다려야 할 시간(초)을 반환합니다. 기다릴 수 없으면 RateLimited.
+        기다릴 시간은 rate_wait 단계로 기록하며, 실제로 기다리는 것은 호출자가 합니다 (asgi.py는 asyncio.sleep).
+        """
+        if not self.applies(query):
+            return 0
+        wait = self.reserve(query, max_wait)
+        if wait > 0:
+            query['stages'].observe('rate_wait', wait)
+        return wait
+
+    def acquire(self, query, max_wait=None):
+        """토큰을 얻을 때까지 기다립니다. 기다릴 수 없으면 RateLimited를 발생시킵니다."""
+        wait = self.schedule(query, max_wait)
+        if wait > 0:
+            time.sleep(wait)
+
+    def refund(self, query):
+        """예약한 토큰을 실행하지 않았을 때 돌려줍니다 (작업 대기열이 가득 찬 경우 등). burst를 넘지 않습니다."""
+        if not self.applies(query):
+            return
+        with db_pool.connection() as conn:
+            conn.executemany('UPDATE rate_limits SET tokens = MIN(?, tokens + 1) WHERE key = ?',
+                             [(burst, key) for key, burst, _ in self._buckets(query)])
+            conn.commit()
+
+    def reset(self):
+        with db_pool.connection() as conn:
+            conn.execute('DELETE FROM rate_limits')
+            conn.commit()
+
+rate_limiter = TokenBucketLimiter({
+    "user": (RATE_LIMIT_USER_BURST, RATE_LIMIT_USER_RATE),
+    "project": (RATE_LIMIT_PROJECT_BURST, RATE_LIMIT_PROJECT_RATE),
+}, RATE_LIMIT_MAX_WAIT)
+
+# --- Background Job Queue ---
+class JobManager:
+    """
+    CLI 실행을 백그라운드 작업으로 처리하는 제한된 크기의 워커 풀입니다.
+    대기열이 가득 차면 submit()이 None을 반환하여 호출자가 요청을 거절할 수 있게 하고,
+    같은 프로젝트의 작업은 project_limit 개까지만 동시에 실행합니다.
+    """
+
+    def __init__(self, workers, project_limit, max_pending, retention_seconds):
+        self.workers = max(1, workers)
+        self.project_limit = max(1, project_limit)
+        self.max_pending = max(1, max_pending)
+        self.retention_seconds = retention_seconds
+        self.jobs = {}  # job_id: job dict
+        self.pending = []  # 대기 중인 job_id 목록 (FIFO)
+        self.running_per_project = {}  # projectId: 실행 중인 작업 수
+        self.condition = threading.Condition()
+        self.threads = []
+
+    def _ensure_workers(self):
+        """워커 스레드를 처음 작업이 들어올 때 시작합니다."""
+        if self.threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker_loop, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _purge_finished(self):
+        """보관 시간이 지난 완료 작업을 제거합니다. condition을 잡은 상태에서 호출해야 합니다."""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job['finished_at'] and now - job['finished_at'] > self.retention_seconds
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def submit(self, query, command, username):
+        """작업을 대기열에 추가하고 job dict를 반환합니다. 대기열이 가득 차면 None을 반환합니다."""
+        import uuid
+
+        with self.condition:
+            self._purge_finished()
+            if len(self.pending) >= self.max_pending:
+                return None
+            job = {
+                "id": str(uuid.uuid4()),
+                "status": "queued",
+                "username": username,
+                "query": query,
+                "command": command,
+                "process": None,
+                "cancel_requested": False,
+                "slot_acquired": False,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+                "result": None,
+                "output": {},  # 큰 출력을 파일로 넘긴 경우 다운로드 정보
+                "error": None
+            }
+            self.jobs[job['id']] = job
+            self.pending.append(job['id'])
+            self._ensure_workers()
+            self.condition.notify_all()
+            return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """작업을 취소합니다. 대기 중이면 즉시 제거하고, 실행 중이면 프로세스를 종료합니다."""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if not job or job['finished_at']:
+                return False
+            job['cancel_requested'] = True
+            if job_id in self.pending:
+                self.pending.remove(job_id)
+                job['status'] = 'cancelled'
+                job['finished_at'] = time.time()
+                return True
+            process = job['process']
+            if process:
+                # 워커 스레드가 정리를 마칠 때까지 기다리지 않고 바로 취소 상태로 보이게 함
+                job['status'] = 'cancelled'
+        if process:
+            kill_process_tree(process)
+        return True
+
+    def _next_job(self):
+        """
+        프로젝트별 동시 실행 제한과 백엔드 동시 실행 제한을 넘지 않는 가장 오래된 대기 작업을 꺼냅니다.
+        느린 백엔드의 작업이 밀려 있어도 다른 백엔드의 작업은 계속 실행됩니다.
+        """
+        for job_id in self.pending:
+            job = self.jobs[job_id]
+            project_id = job['query']['project_id']
+            if self.running_per_project.get(project_id, 0) >= self.project_limit:
+                continue
+            backend = job['query']['backend']
+            if not backend.handler:
+                if not backend.try_acquire():
+                    continue
+                job['slot_acquired'] = True
+            self.pending.remove(job_id)
+            return job
+        return None
+
+    def _worker_loop(self):
+        while True:
+            with self.condition:
+                job = self._next_job()
+                while job is None:
+                    # 백엔드 슬롯은 동기 요청이 반납할 수도 있으므로 주기적으로 다시 확인
+                    self.condition.wait(1.0)
+                    job = self._next_job()
+                project_id = job['query']['project_id']
+                self.running_per_project[project_id] = self.running_per_project.get(project_id, 0) + 1
+                job['status'] = 'running'
+                job['started_at'] = time.time()
+            try:
+                self._run(job)
+            finally:
+                with self.condition:
+                    self.running_per_project[project_id] -= 1
+                    if not self.running_per_project[project_id]:
+                        del self.running_per_project[project_id]
+                    job['finished_at'] = time.time()
+                    self.condition.notify_all()
+
+    def _attach_process(self, job, process):
+        with self.condition:
+            job['process'] = process
+            cancelled = job['cancel_requested']
+        if cancelled:
+            kill_process_tree(process)
+
+    def _run(self, job):
+        query = job['query']
+        try:
+            assistant_response = execute_query(
+                query,
+                job['command'],
+                on_spawn=lambda process: self._attach_process(job, process),
+                slot_acquired=job['slot_acquired']
+            )
+            output = save_query_history(query, assistant_response)
         except Exception as e:
-            return jsonify({"error": str(e)}), 500
+            # describe()가 반쯤 바뀐 작업을 읽지 않도록 상태는 condition을 잡고 바꿈
+            with self.condition:
+                if job['cancel_requested']:
+                    job['status'] = 'cancelled'
+                else:
+                    job['status'] = 'failed'
+                    job['error'] = str(e)
+                job['process'] = None
+                outcome = 'cancelled' if job['status'] == 'cancelled' else 'error'
+        else:
+            with self.condition:
+                job['output'] = output
+                job['result'] = assistant_response
+                # 취소가 받아들여진 작업(프로세스 없이 실행되었거나 프로세스가 이미 끝난 경우 포함)은 완료로 바꾸지 않음
+                job['status'] = 'cancelled' if job['cancel_requested'] else 'completed'
+                job['process'] = None
+                outcome = 'cancelled' if job['status'] == 'cancelled' else 'ok'
+        query['stages'].finish(outcome)
+
+    def describe(self, job):
+        """API 응답용 작업 정보를 반환합니다."""
+        with self.condition:
+            position = self.pending.index(job['id']) + 1 if job['id'] in self.pending else None
+            return {
+                "jobId": job['id'],
+                "status": job['status'],
+                "projectId": job['query']['project_id'],
+                "sessionId": job['query']['session_id'],
+                "cli": job['query']['cli'],
+                "queuePosition": position,
+                "createdAt": job['created_at'],
+                "startedAt": job['started_at'],
+                "finishedAt": job['finished_at'],
+                "error": job['error']
+            }
+
+job_manager = JobManager(per_worker(JOB_WORKERS), JOB_PROJECT_CONCURRENCY, JOB_QUEUE_SIZE, JOB_RETENTION_SECONDS)
+
+def get_user_job(job_id):
+    """현재 사용자가 만든 작업을 반환합니다. 다른 사용자의 작업은 None으로 취급합니다."""
+    job = job_manager.get(job_id)
+    if not job or job['username'] != session.get('username'):
+        return None
+    return job
 
-    # Save to database (works for echo, gemini, claude)
+# --- Query Pipeline ---
+# /api/query, /api/query/stream과 asgi.py의 비동기 버전이 공유하는 단계입니다.
+# 오류는 (response_data, status_code, headers)로 돌려주므로 Flask(json_reply)와 ASGI 양쪽에서 그대로 응답할 수 있습니다.
+def begin_query(query):
+    """
+    CLI를 실행하기 전 단계를 처리합니다: 응답 캐시 확인, 프로세스 없는 백엔드(echo 등) 처리, CLI 명령 생성, 요청 빈도 제한.
+    Returns (plan, None) on success, otherwise (None, (response_data, status_code, headers)).
+    plan의 answer가 None이면 호출자가 wait초 기다린 뒤 command로 CLI를 실행하고 answer를 채웁니다.
+    """
+    answer, cache_key = cached_response(query)
+    plan = {"answer": answer, "cached": answer is not None, "cache_key": cache_key, "command": None, "wait": 0}
+    if plan['cached']:
+        # 캐시된 응답은 CLI를 실행하지 않으므로 한도에 포함하지 않음
+        return plan, None
+    if query['backend'].handler:
+        plan['answer'] = query['backend'].handler(query)
+        return plan, None
+
+    command, error = build_cli_command(query)
+    if error:
+        return None, query_error_reply(query, QueryError(*error))
+    plan['command'] = command
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO history (projectId, sessionId, timestamp, cli, user_message, assistant_message)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (project_id, session_id, datetime.now(), cli_tool, message, assistant_response))
-        conn.commit()
-        conn.close()
+        plan['wait'] = rate_limiter.schedule(query)
+    except RateLimited as e:
+        return None, query_error_reply(query, e)
+    return plan, None
 
-        return jsonify({
-            "assistant_message": assistant_response,
-            "sessionId": session_id
-        })
+def complete_query(query, plan):
+    """
+    새로 실행한 CLI 응답은 캐시에 넣고, 대화를 history에 저장한 뒤 결과를 기록합니다.
+    Returns (result, None) on success, otherwise (None, (response_data, status_code, headers)).
+    """
+    if not plan['cached']:
+        store_cached_response(query, plan['cache_key'], plan['answer'])
+    try:
+        output = save_query_history(query, plan['answer'])
     except Exception as e:
-        return jsonify({"error": f"Database error: {str(e)}"}), 500
+        query['stages'].finish('error')
+        return None, ({"error": f"Database error: {str(e)}"}, 500, {})
+
+    result = {
+        "assistant_message": plan['answer'],
+        "sessionId": query['session_id'],
+        **output
+    }
+    if plan['cached']:
+        result['cached'] = True
+    query['stages'].finish('cached' if plan['cached'] else 'ok')
+    return result, None
+
+def query_error_reply(query, error):
+    """쿼리 실패를 (response_data, status_code, headers)로 바꾸고 queries_total에 결과를 기록합니다."""
+    if isinstance(error, RateLimited):
+        query['stages'].finish('rate_limited')
+        return ({"error": str(error), "retryAfter": error.retry_after}, 429,
+                {'Retry-After': str(error.retry_after)})
+    if isinstance(error, QueryError):
+        query['stages'].finish(query_error_outcome(error))
+        return {"error": str(error)}, error.status, {'Retry-After': '5'} if error.status == 503 else {}
+    query['stages'].finish('error')
+    return {"error": str(error)}, 500, {}
+
+def query_error_outcome(error):
+    """QueryError를 queries_total의 outcome 레이블로 바꿉니다 (409: 사용자 취소)."""
+    return 'cancelled' if error.status == 409 else 'error'
+
+def json_reply(reply):
+    """(response_data, status_code, headers)를 Flask 응답으로 바꿉니다."""
+    data, status, headers = reply
+    return jsonify(data), status, headers
+
+@app.route('/api/query', methods=['POST'])
+@login_required
+def handle_query():
+    """
+    Executes a CLI command in the specified project directory and returns the result.
+    Saves the conversation to the history.
+    """
+    query, error = prepare_query(request.json)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+
+    plan, reply = begin_query(query)
+    if reply:
+        return json_reply(reply)
+
+    if plan['answer'] is None:
+        time.sleep(plan['wait'])
+        try:
+            plan['answer'] = execute_query(query, plan['command'])
+        except Exception as e:
+            return json_reply(query_error_reply(query, e))
+
+    result, reply = complete_query(query, plan)
+    if reply:
+        return json_reply(reply)
+    return jsonify(result)
+
+@app.route('/api/query/stream', methods=['POST'])
+@login_required
+def handle_query_stream():
+    """
+    /api/query의 스트리밍 버전입니다.
+    CLI의 stdout을 도착하는 대로 SSE 이벤트(session, chunk, done, error)로 전달하고,
+    스트림이 끝나면 전체 응답을 history에 저장합니다.
+    """
+    query, error = prepare_query(request.json)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+
+    plan, reply = begin_query(query)
+    if reply:
+        return json_reply(reply)
+    time.sleep(plan['wait'])
+    backend = query['backend']
+
+    def generate():
+        try:
+            yield from stream_events()
+        finally:
+            # 끝까지 전송되지 않았으면 클라이언트가 연결을 끊은 것
+            query['stages'].finish('disconnected')
+
+    def stream_events():
+        yield sse_event('session', {"sessionId": query['session_id'], "queryId": query['query_id']})
+
+        if plan['answer'] is not None:
+            # 캐시된 응답이나 프로세스 없이 처리하는 백엔드 (echo 등)
+            yield sse_event('chunk', {"text": plan['answer']})
+        else:
+            try:
+                backend.acquire()
+            except BackendBusy as e:
+                yield sse_event('error', query_error_reply(query, QueryError(str(e), 503))[0])
+                return
+            capture = OutputCapture()
+            try:
+                with active_queries.track(query) as run:
+                    for text in stream_query_chunks(query, plan['command'], on_spawn=run.attach):
+                        capture.write(text)
+                        if backend.streaming:
+                            yield sse_event('chunk', {"text": text})
+            except Exception as e:
+                capture.discard()
+                yield sse_event('error', query_error_reply(query, e)[0])
+                return
+            except BaseException:
+                # 클라이언트 연결 종료 등
+                capture.discard()
+                raise
+            finally:
+                backend.release()
+            plan['answer'] = finish_capture(query, capture)
+            if not backend.streaming:
+                yield sse_event('chunk', {"text": plan['answer']})
+
+        result, reply = complete_query(query, plan)
+        if reply:
+            yield sse_event('error', reply[0])
+            return
+        yield sse_event('done', result)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/api/query/<query_id>/cancel', methods=['POST'])
+@login_required
+def cancel_query(query_id):
+    """실행 중인 쿼리를 취소하고 CLI 프로세스 트리를 종료합니다."""
+    if not active_queries.cancel(query_id, session.get('username')):
+        return jsonify({"error": "Query not found"}), 404
+    return jsonify({"success": True, "queryId": query_id})
+
+@app.route('/api/backends', methods=['GET'])
+@login_required
+def list_backends():
+    """등록된 CLI 백엔드와 설정(스트리밍 지원, 동시 실행 제한, 제한 시간)을 반환합니다."""
+    return jsonify([backend.describe() for backend in CLI_BACKENDS.values()])
+
+@app.route('/api/jobs', methods=['POST'])
+@login_required
+def submit_job():
+    """
+    /api/query와 같은 요청을 백그라운드 작업으로 등록하고 즉시 jobId를 반환합니다.
+    대기열이 가득 차면 503과 Retry-After 헤더를 반환합니다.
+    """
+    query, error = prepare_query(request.json)
+    if error:
+        return jsonify({"error": error[0]}), error[1]
+
+    command = None
+    if not query['backend'].handler:
+        command, error = build_cli_command(query)
+        if error:
+            return jsonify({"error": error[0]}), error[1]
+        try:
+            # 작업은 이미 대기열에서 기다리므로 토큰이 없으면 바로 거절
+            rate_limiter.acquire(query, max_wait=0)
+        except RateLimited as e:
+            return json_reply(query_error_reply(query, e))
+
+    job = job_manager.submit(query, command, session.get('username'))
+    if not job:
+        # 실행하지 않은 작업의 토큰은 돌려줌
+        rate_limiter.refund(query)
+        response = jsonify({"error": "작업 대기열이 가득 찼습니다. 잠시 후 다시 시도해주세요."})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    return jsonify(job_manager.describe(job)), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@login_required
+def get_job_status(job_id):
+    """작업 상태를 반환합니다."""
+    job = get_user_job(job_id)
+    if not job:
+        return jsonify({"error": "작업을 찾을 수 없습니다."}), 404
+    return jsonify(job_manager.describe(job))
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+@login_required
+def get_job_result(job_id):
+    """
+    완료된 작업의 결과를 /api/query와 같은 형식으로 반환합니다.
+    아직 실행 중이면 202와 현재 상태를 반환합니다.
+    """
+    job = get_user_job(job_id)
+    if not job:
+        return jsonify({"error": "작업을 찾을 수 없습니다."}), 404
+
+    if job['status'] in ('queued', 'running'):
+        return jsonify(job_manager.describe(job)), 202
+    if job['status'] == 'cancelled':
+        return jsonify({"error": "작업이 취소되었습니다.", "status": job['status']}), 409
+    if job['status'] == 'failed':
+        return jsonify({"error": job['error'], "status": job['status']}), 500
+
+    return jsonify({
+        "assistant_message": job['result'],
+        "sessionId": job['query']['session_id'],
+        "status": job['status'],
+        **job['output']
+    })
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+def cancel_job(job_id):
+    """대기 중이거나 실행 중인 작업을 취소합니다."""
+    job = get_user_job(job_id)
+    if not job:
+        return jsonify({"error": "작업을 찾을 수 없습니다."}), 404
+    if not job_manager.cancel(job_id):
+        return jsonify({"error": "이미 종료된 작업입니다.", "status": job['status']}), 409
+    return jsonify({"success": True, "jobId": job_id})
+
+def build_history_query(args, default_limit):
+    """
+    /api/history 요청 파라미터로 SQL과 바인딩 값을 만듭니다.
+    Returns ((sql, params, limit, order), None) on success, otherwise (None, error_message).
+    limit이 None이면 LIMIT 없이 조회합니다.
+    """
+    project_id = args.get('projectId')
+    session_id = args.get('sessionId')
+
+    if not project_id:
+        return None, "projectId is required"
+
+    try:
+        limit = args.get('limit')
+        limit = default_limit if limit is None else int(limit)
+    except ValueError:
+        return None, "limit must be an integer"
+    try:
+        # 잘못된 커서를 무시하고 최신 페이지를 주면 클라이언트가 중복 행을 받으므로 400으로 거절
+        before_id = args.get('before_id')
+        before_id = None if before_id is None else int(before_id)
+        after_id = args.get('after_id')
+        after_id = None if after_id is None else int(after_id)
+    except ValueError:
+        return None, "before_id/after_id must be integers"
+    if before_id is not None and after_id is not None:
+        return None, "before_id and after_id cannot be used together"
+    if limit is not None:
+        limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+
+    conditions = ["projectId = ?"]
+    params = [project_id]
+    if session_id:
+        # 특정 세션의 히스토리만 조회
+        conditions.append("sessionId = ?")
+        params.append(session_id)
+    # 전체 내보내기(limit 없음)는 항상 오래된 것부터
+    order = "ASC" if after_id is not None or limit is None else "DESC"
+    if after_id is not None:
+        conditions.append("id > ?")
+        params.append(after_id)
+    elif before_id is not None:
+        conditions.append("id < ?")
+        params.append(before_id)
+
+    sql = f"SELECT {HISTORY_COLUMNS} FROM history WHERE {' AND '.join(conditions)} ORDER BY id {order}"
+    if limit is not None:
+        # limit + 1 개를 읽어 다음 페이지 존재 여부를 판단
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+    return (sql, params, limit, order), None
+
+def stream_history_rows(sql, params, fmt, headers=None):
+    """
+    SQLite 커서를 HISTORY_STREAM_BATCH 행씩 읽으면서 인코딩한 행을 바로 내보내는 응답을 만듭니다.
+    전체 결과를 메모리에 올리지 않으므로 큰 프로젝트도 일정한 메모리로 내보낼 수 있습니다.
+    fmt: 'ndjson' (한 줄에 한 행) 또는 'json' (청크 단위로 전송되는 JSON 배열)
+    """
+    def generate():
+        with db_pool.connection() as conn:
+            cursor = conn.execute(sql, params)
+            if fmt == 'json':
+                yield '['
+            first = True
+            while True:
+                rows = cursor.fetchmany(HISTORY_STREAM_BATCH)
+                if not rows:
+                    break
+                encoded = [json.dumps(dict(row), ensure_ascii=False, default=str) for row in rows]
+                if fmt == 'json':
+                    chunk = ','.join(encoded)
+                    yield chunk if first else ',' + chunk
+                else:
+                    yield '\n'.join(encoded) + '\n'
+                first = False
+            if fmt == 'json':
+                yield ']'
+
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+STREAM_FORMATS = {'ndjson': 'ndjson', 'json-stream': 'json'}  # format 파라미터: 스트리밍 인코딩
 
 @app.route('/api/history', methods=['GET'])
 @login_required
 def get_history():
-    """Returns the chat history for a given project."""
+    """
+    Returns the chat history for a given project, one page at a time (keyset pagination on id).
+    - 파라미터 없음: 가장 최근 limit 개
+    - before_id: 해당 id보다 오래된 limit 개 (위로 스크롤 시 이전 대화 로드)
+    - after_id: 해당 id 이후에 추가된 행만 (클라이언트 캐시 증분 갱신)
+    결과는 항상 id 오름차순이며, 더 가져올 행이 있으면 X-Has-More: true 헤더를 설정합니다.
+    format=ndjson 또는 format=json-stream이면 커서를 순회하며 스트리밍하고,
+    이때는 limit을 지정하지 않으면 조건에 맞는 모든 행을 오름차순으로 보냅니다.
+    """
+    fmt = request.args.get('format')
+    if fmt and fmt not in STREAM_FORMATS:
+        return jsonify({"error": f"Unsupported format: {fmt}"}), 400
+
+    query, error = build_history_query(request.args, None if fmt else HISTORY_PAGE_SIZE)
+    if error:
+        return jsonify({"error": error}), 400
+    sql, params, limit, order = query
+
+    # Security check is implicitly done by querying with projectId
+    if not fmt:
+        version, last_modified = history_version(request.args['projectId'], request.args.get('sessionId'))
+        return conditional_response(version, last_modified, lambda: history_page(sql, params, limit, order))
+    else:
+        if limit is not None:
+            # 스트리밍에서는 다음 페이지 확인용 추가 행을 읽지 않음
+            params[-1] = limit
+            if order == "DESC":
+                # 최근 limit 개(최대 HISTORY_MAX_PAGE_SIZE)만 다시 오름차순으로 정렬
+                sql = f"SELECT * FROM ({sql}) ORDER BY id ASC"
+        return stream_history_rows(sql, params, STREAM_FORMATS[fmt])
+
+def history_page(sql, params, limit, order):
+    """build_history_query로 만든 페이지 조회를 실행하여 JSON 응답을 만듭니다."""
+    with db_pool.connection() as conn:
+        rows = conn.execute(sql, params).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "DESC":
+        rows.reverse()
+
+    history_list = [dict(row) for row in rows]
+    response = jsonify(history_list)
+    response.headers['X-Has-More'] = 'true' if has_more else 'false'
+    return response
+
+@app.route('/api/history/export', methods=['GET'])
+@login_required
+def export_history():
+    """
+    프로젝트(또는 세션)의 전체 히스토리를 스트리밍으로 내보냅니다. 백업/이관용.
+    format: ndjson (기본값) 또는 json-stream
+    """
     project_id = request.args.get('projectId')
     session_id = request.args.get('sessionId')
-    
+    fmt = request.args.get('format', 'ndjson')
+
     if not project_id:
         return jsonify({"error": "projectId is required"}), 400
+    if fmt not in STREAM_FORMATS:
+        return jsonify({"error": f"Unsupported format: {fmt}"}), 400
 
-    # Security check is implicitly done by querying with projectId
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
+    sql = f"SELECT {HISTORY_COLUMNS} FROM history WHERE projectId = ?"
+    params = [project_id]
     if session_id:
-        # 특정 세션의 히스토리만 조회
-        cursor.execute("SELECT * FROM history WHERE projectId = ? AND sessionId = ? ORDER BY timestamp ASC", 
-                      (project_id, session_id))
-    else:
-        # 전체 히스토리 조회 (기존 동작)
-        cursor.execute("SELECT * FROM history WHERE projectId = ? ORDER BY timestamp ASC", (project_id,))
-    
-    rows = cursor.fetchall()
-    conn.close()
+        sql += " AND sessionId = ?"
+        params.append(session_id)
+    sql += " ORDER BY id ASC"
 
-    history_list = [dict(row) for row in rows]
-    return jsonify(history_list)
+    extension = 'ndjson' if fmt == 'ndjson' else 'json'
+    filename = re.sub(r'[^A-Za-z0-9._-]', '_', project_id)
+    headers = {'Content-Disposition': f'attachment; filename="{filename}-history.{extension}"'}
+    return stream_history_rows(sql, params, STREAM_FORMATS[fmt], headers=headers)
+
+@app.route('/api/history/<int:history_id>/output', methods=['GET'])
+@login_required
+def download_history_output(history_id):
+    """
+    파일로 넘긴 큰 CLI 출력 전체를 반환합니다. Range 요청을 지원하므로 일부만 받거나 이어 받을 수 있습니다.
+    download=1이면 첨부 파일로 내려받습니다.
+    """
+    with db_pool.connection() as conn:
+        row = conn.execute('SELECT output_file FROM history WHERE id = ?', (history_id,)).fetchone()
+    path = output_path(row['output_file']) if row else None
+    if not path or not os.path.isfile(path):
+        return jsonify({"error": "Output not found"}), 404
+    return send_file(
+        path,
+        mimetype='text/plain; charset=utf-8',
+        as_attachment=request.args.get('download') in ('1', 'true'),
+        download_name=f"output-{history_id}.txt",
+        conditional=True
+    )
 
 @app.route('/api/history/sessions', methods=['GET'])
 @login_required
@@ -886,49 +3884,107 @@ def get_history_sessions():
     if not project_id:
         project_id = "__root__"
 
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # 각 세션의 첫 번째 메시지와 타임스탬프를 가져옴
-    cursor.execute('''
-        SELECT 
-            sessionId,
-            MIN(timestamp) as timestamp,
-            MIN(id) as first_id
-        FROM history 
-        WHERE projectId = ? AND sessionId IS NOT NULL
-        GROUP BY sessionId
-        ORDER BY timestamp DESC
-    ''', (project_id,))
-    
-    sessions = cursor.fetchall()
-    
-    # 각 세션의 첫 메시지 내용 가져오기
-    session_list = []
-    for session in sessions:
-        cursor.execute('''
-            SELECT user_message 
-            FROM history 
-            WHERE id = ?
-        ''', (session['first_id'],))
-        
-        first_msg = cursor.fetchone()
-        first_message = first_msg['user_message'] if first_msg else ''
-        
-        # 메시지가 너무 길면 잘라내기
-        if len(first_message) > 100:
-            first_message = first_message[:100] + '...'
-        
-        session_list.append({
-            'sessionId': session['sessionId'],
-            'timestamp': session['timestamp'],
-            'firstMessage': first_message
-        })
-    
-    conn.close()
+    version, last_modified = history_version(project_id)
+    return conditional_response(version, last_modified, lambda: session_list_response(project_id))
+
+def session_list_response(project_id):
+    # sessions 요약 테이블에서 (projectId, started_at) 인덱스 범위 스캔 한 번으로 조회
+    with db_pool.connection() as conn:
+        rows = conn.execute('''
+            SELECT sessionId, started_at, last_at, first_message, turn_count
+            FROM sessions
+            WHERE projectId = ?
+            ORDER BY started_at DESC
+        ''', (project_id,)).fetchall()
+
+    session_list = [{
+        'sessionId': row['sessionId'],
+        'timestamp': row['started_at'],
+        'lastTimestamp': row['last_at'],
+        'firstMessage': row['first_message'],
+        'turnCount': row['turn_count']
+    } for row in rows]
+
     return jsonify(session_list)
 
+def build_fts_query(text):
+    """
+    검색어를 FTS5 MATCH 식으로 바꿉니다. 각 단어를 따옴표로 감싼 접두어 검색으로 만들어
+    FTS 문법 오류를 막고, 한국어 조사가 붙은 단어("서버를")도 "서버"로 찾을 수 있게 합니다.
+    """
+    terms = [term.replace('"', '') for term in text.split()][:SEARCH_MAX_TERMS]
+    return ' '.join(f'"{term}"*' for term in terms if term)
+
+def highlight_snippet(snippet):
+    """FTS5 snippet의 표시 문자(\x02, \x03)를 HTML 이스케이프 후 <mark> 태그로 바꿉니다."""
+    import html
+    return html.escape(snippet or '').replace('\x02', '<mark>').replace('\x03', '</mark>')
+
+@app.route('/api/history/search', methods=['GET'])
+@login_required
+def search_history():
+    """
+    history_fts 인덱스로 대화 내용을 검색합니다.
+    q(필수), projectId, sessionId, cli로 거르고, 관련도(bm25) 순으로 limit/offset 페이지를 반환합니다.
+    snippet은 HTML 이스케이프되어 있고 일치한 부분만 <mark>로 감싸져 있습니다.
+    """
+    if not HISTORY_FTS:
+        return jsonify({"error": "History search is not available (SQLite FTS5 missing)"}), 501
+
+    match = build_fts_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({"error": "Missing q"}), 400
+    try:
+        limit = int(request.args.get('limit', SEARCH_PAGE_SIZE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    offset = max(0, offset)
+
+    conditions = ['history_fts MATCH ?']
+    params = [match]
+    for arg, column in (('projectId', 'h.projectId'), ('sessionId', 'h.sessionId'), ('cli', 'h.cli')):
+        value = request.args.get(arg)
+        if value:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+
+    # 다음 페이지 유무를 알기 위해 한 행 더 읽음
+    sql = f'''
+        SELECT h.id, h.projectId, h.sessionId, h.timestamp, h.cli,
+               snippet(history_fts, 0, char(2), char(3), '…', 12) AS user_snippet,
+               snippet(history_fts, 1, char(2), char(3), '…', 24) AS assistant_snippet,
+               bm25(history_fts) AS score
+        FROM history_fts
+        JOIN history h ON h.id = history_fts.rowid
+        WHERE {' AND '.join(conditions)}
+        ORDER BY score
+        LIMIT ? OFFSET ?
+    '''
+    try:
+        with db_pool.connection() as conn:
+            rows = conn.execute(sql, params + [limit + 1, offset]).fetchall()
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": f"Invalid search query: {e}"}), 400
+
+    results = [{
+        'id': row['id'],
+        'projectId': row['projectId'],
+        'sessionId': row['sessionId'],
+        'timestamp': row['timestamp'],
+        'cli': row['cli'],
+        'userSnippet': highlight_snippet(row['user_snippet']),
+        'assistantSnippet': highlight_snippet(row['assistant_snippet']),
+        'score': row['score']
+    } for row in rows[:limit]]
+
+    return jsonify({
+        "results": results,
+        "hasMore": len(rows) > limit,
+        "nextOffset": offset + limit if len(rows) > limit else None
+    })
+
 
 # --- Frontend Routes ---
 
@@ -951,8 +4007,17 @@ def index():
     """Serves the main HTML page."""
     return render_template('index.html')
 
+# --- Startup ---
+def startup():
+    """서버를 시작할 때 한 번 실행합니다 (python app.py, serve.py, asgi.py 공통)."""
+    init_db()
+    # 재시작하면 로그인 잠금 해제 (serve.py의 워커 재시작 시에는 유지)
+    reset_login_state()
+    # 지원하는 CLI 경로를 미리 찾아 두고, 없는 도구는 첫 요청 전에 알림
+    refresh_command_cache()
+
 # --- Main Execution ---
 if __name__ == '__main__':
-    init_db()
-    # For development, debug=True is fine. For production, use a proper WSGI server.
+    startup()
+    # For development, debug=True is fine. For production, use serve.py (multi-process waitress).
     app.run(host='0.0.0.0', port=SERVER_PORT, debug=True)
@@ -0,0 +1,387 @@
+"""
+ASGI 진입점입니다. 실행 예:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+/api/query와 /api/query/stream은 asyncio.create_subprocess_exec로 CLI를 실행하는 비동기 핸들러가 처리하므로,
+CLI 실행을 기다리는 동안 스레드를 점유하지 않아 한 프로세스에서 많은 요청과 스트림을 동시에 유지할 수 있습니다.
+나머지 라우트는 a2wsgi로 감싼 기존 Flask 앱이 스레드 풀(ASGI_WSGI_WORKERS)에서 그대로 처리합니다.
+(필요 패키지: pip install uvicorn a2wsgi)
+"""
+import asyncio
+import codecs
+import io
+import json
+import os
+import subprocess
+import time
+from urllib.parse import unquote
+
+from a2wsgi import WSGIMiddleware
+from flask import request, session
+
+from app import (
+    app, startup, prepare_query, begin_query, complete_query, query_error_reply, stream_query_chunks,
+    sse_event, kill_process_tree, active_queries, QueryError, BackendBusy, BACKEND_WAIT_TIMEOUT, CLI_WARM_WORKERS,
+    PROCESS_GROUP_KWARGS, SERVER_PORT, metrics, OutputCapture, TailBuffer, finish_capture, OUTPUT_STDERR_TAIL_BYTES
+)
+
+# 동기 Flask 라우트를 실행할 스레드 수 (SSE 구독(/api/projects/events)도 하나씩 차지함)
+ASGI_WSGI_WORKERS = int(os.getenv('ASGI_WSGI_WORKERS', '32'))
+
+flask_application = WSGIMiddleware(app, workers=ASGI_WSGI_WORKERS)
+
+# --- Helpers ---
+class AsyncProcessHandle:
+    """QueryRun과 kill_process_tree가 사용하는 Popen 인터페이스(pid, poll, kill)를 asyncio 프로세스에 맞춥니다."""
+
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+
+    def poll(self):
+        return self.process.returncode
+
+    def kill(self):
+        try:
+            self.process.kill()
+        except ProcessLookupError:
+            pass
+
+def build_environ(scope, body):
+    """Flask 요청 컨텍스트(세션, request.json)를 만들기 위한 최소한의 WSGI environ을 만듭니다."""
+    server = scope.get('server') or ('localhost', SERVER_PORT)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': unquote(scope['path']),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': io.StringIO(),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def send_json(send, status, data, headers=None):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]
+                   + [(k.encode(), v.encode()) for k, v in (headers or {}).items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_reply(send, reply):
+    """app.begin_query 등이 돌려준 (response_data, status_code, headers)를 JSON 응답으로 보냅니다."""
+    data, status, headers = reply
+    await send_json(send, status, data, headers)
+
+def load_query(scope, body):
+    """
+    Flask 요청 컨텍스트 안에서 로그인 여부를 확인하고 prepare_query로 쿼리를 검증합니다.
+    Returns (query, None) on success, otherwise (None, (response_data, status_code)).
+    """
+    with app.request_context(build_environ(scope, body)):
+        if not session.get('authenticated'):
+            return None, ({"error": "인증이 필요합니다.", "authenticated": False}, 401)
+        query, error = prepare_query(request.get_json(silent=True))
+        if error:
+            return None, ({"error": error[0]}, error[1])
+        return query, None
+
+async def acquire_backend(backend):
+    """백엔드 동시 실행 슬롯을 이벤트 루프를 막지 않고 기다립니다."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + BACKEND_WAIT_TIMEOUT
+    while not backend.try_acquire():
+        if loop.time() >= deadline:
+            raise backend.busy_error()
+        await asyncio.sleep(0.05)
+
+async def iterate_in_thread(iterator):
+    """동기 iterator를 스레드 풀에서 소비하면서 항목을 비동기로 yield 합니다."""
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    finished = object()
+
+    def pump():
+        try:
+            for item in iterator:
+                loop.call_soon_threadsafe(items.put_nowait, (item, None))
+        except BaseException as e:
+            loop.call_soon_threadsafe(items.put_nowait, (finished, e))
+        else:
+            loop.call_soon_threadsafe(items.put_nowait, (finished, None))
+
+    loop.run_in_executor(None, pump)
+    while True:
+        item, error = await items.get()
+        if item is finished:
+            if error:
+                raise error
+            return
+        yield item
+
+async def cli_chunks(query, command, run):
+    """
+    CLI 출력을 도착하는 대로 텍스트 조각으로 yield 합니다. 실패하면 QueryError를 발생시킵니다.
+    상주 프로세스(동기 파이프 프로토콜)를 쓰는 세션은 스레드 풀에서 기존 stream_query_chunks로 처리합니다.
+    """
+    if CLI_WARM_WORKERS and query['backend'].warm_protocol:
+        async for text in iterate_in_thread(stream_query_chunks(query, command, on_spawn=run.attach)):
+            yield text
+        return
+
+    stages = query['stages']
+    stages.spawning()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            cwd=query['project_path'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            **PROCESS_GROUP_KWARGS
+        )
+    except Exception as e:
+        raise QueryError(str(e))
+    stages.spawned()
+    handle = AsyncProcessHandle(process)
+    run.attach(handle)
+    # stderr 파이프가 가득 차서 프로세스가 멈추지 않도록 따로 읽고, 마지막 부분만 보관합니다.
+    stderr_tail = TailBuffer(OUTPUT_STDERR_TAIL_BYTES)
+
+    async def drain_stderr():
+        while True:
+            data = await process.stderr.read(8192)
+            if not data:
+                return
+            stderr_tail.append(data)
+    stderr_task = asyncio.ensure_future(drain_stderr())
+
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    try:
+        while True:
+            data = await process.stdout.read(4096)
+            if not data:
+                break
+            stages.first_output()
+            text = decoder.decode(data)
+            if text:
+                yield text
+        text = decoder.decode(b'', final=True)
+        if text:
+            yield text
+        await process.wait()
+    finally:
+        # 클라이언트가 연결을 끊었거나 CLI가 남긴 자식 프로세스가 있으면 함께 정리합니다.
+        kill_process_tree(handle)
+        if process.returncode is None:
+            await process.wait()
+
+    await stderr_task
+    if process.returncode != 0:
+        raise QueryError(f"CLI command failed with exit code {process.returncode}:\n{stderr_tail.text()}")
+
+async def run_query(query, command, on_chunk=None):
+    """
+    쿼리를 실행하고 응답 텍스트를 반환합니다. 실패하면 QueryError를 발생시킵니다.
+    on_chunk가 주어지면 streaming 백엔드의 출력 조각을 도착하는 대로 전달합니다.
+    출력은 OutputCapture에 모으므로 아주 큰 출력은 파일로 넘어갑니다 (app.run_query_process와 같음).
+    """
+    backend = query['backend']
+    try:
+        await acquire_backend(backend)
+    except BackendBusy as e:
+        raise QueryError(str(e), 503)
+    capture = OutputCapture()
+    try:
+        with active_queries.track(query) as run:
+            try:
+                async for text in cli_chunks(query, command, run):
+                    capture.write(text)
+                    if on_chunk and backend.streaming:
+                        await on_chunk(text)
+            except asyncio.CancelledError:
+                # 클라이언트 연결 종료: 실행 중인 프로세스 트리 정리
+                run.cancel()
+                raise
+    except BaseException:
+        capture.discard()
+        raise
+    finally:
+        backend.release()
+    return finish_capture(query, capture)
+
+async def watch_disconnect(receive, task):
+    """클라이언트가 연결을 끊으면 응답을 만드는 task를 취소합니다."""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            task.cancel()
+            return
+
+# --- Async Routes ---
+# 캐시, 명령 생성, 요청 빈도 제한, 저장은 app.begin_query/complete_query를 그대로 쓰고 CLI 실행만 비동기로 합니다.
+# DB를 쓰는 단계는 이벤트 루프를 막지 않도록 스레드에서 실행합니다.
+async def handle_query(scope, receive, send):
+    """app.handle_query의 비동기 버전입니다."""
+    body = await read_body(receive)
+    if body is None:
+        return
+    query, error = load_query(scope, body)
+    if error:
+        return await send_json(send, error[1], error[0])
+
+    plan, reply = await asyncio.to_thread(begin_query, query)
+    if reply:
+        return await send_reply(send, reply)
+
+    if plan['answer'] is None:
+        # 토큰을 기다리는 동안 스레드를 점유하지 않음
+        await asyncio.sleep(plan['wait'])
+        try:
+            plan['answer'] = await run_query(query, plan['command'])
+        except Exception as e:
+            # QueryError 외의 실패(출력 파일 쓰기 오류 등)도 app.handle_query처럼 JSON으로 응답 (취소는 그대로 전파)
+            return await send_reply(send, query_error_reply(query, e))
+
+    result, reply = await asyncio.to_thread(complete_query, query, plan)
+    if reply:
+        return await send_reply(send, reply)
+    await send_json(send, 200, result)
+
+async def handle_query_stream(scope, receive, send):
+    """app.handle_query_stream의 비동기 버전입니다. 같은 SSE 이벤트(session, chunk, done, error)를 보냅니다."""
+    body = await read_body(receive)
+    if body is None:
+        return
+    query, error = load_query(scope, body)
+    if error:
+        return await send_json(send, error[1], error[0])
+
+    plan, reply = await asyncio.to_thread(begin_query, query)
+    if reply:
+        return await send_reply(send, reply)
+    await asyncio.sleep(plan['wait'])
+    backend = query['backend']
+
+    async def emit(event, data):
+        await send({'type': 'http.response.body', 'body': sse_event(event, data).encode('utf-8'), 'more_body': True})
+
+    async def stream():
+        await emit('session', {"sessionId": query['session_id'], "queryId": query['query_id']})
+
+        if plan['answer'] is not None:
+            # 캐시된 응답이나 프로세스 없이 처리하는 백엔드 (echo 등)
+            await emit('chunk', {"text": plan['answer']})
+        else:
+            try:
+                plan['answer'] = await run_query(query, plan['command'], on_chunk=lambda text: emit('chunk', {"text": text}))
+            except Exception as e:
+                await emit('error', query_error_reply(query, e)[0])
+                return
+            if not backend.streaming:
+                await emit('chunk', {"text": plan['answer']})
+
+        result, reply = await asyncio.to_thread(complete_query, query, plan)
+        if reply:
+            await emit('error', reply[0])
+            return
+        await emit('done', result)
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ],
+    })
+    task = asyncio.ensure_future(stream())
+    watcher = asyncio.ensure_future(watch_disconnect(receive, task))
+    try:
+        await task
+    except asyncio.CancelledError:
+        return
+    finally:
+        watcher.cancel()
+        # 끝까지 전송되지 않았으면 클라이언트가 연결을 끊은 것
+        query['stages'].finish('disconnected')
+    await send({'type': 'http.response.body', 'body': b''})
+
+# 비동기로 처리하는 라우트: (method, path) -> handler
+ASYNC_ROUTES = {
+    ('POST', '/api/query'): handle_query,
+    ('POST', '/api/query/stream'): handle_query_stream,
+}
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def timed_route(handler, scope, receive, send):
+    """비동기 라우트의 지연 시간을 Flask 라우트와 같은 http_request_duration_seconds에 기록합니다."""
+    started = time.perf_counter()
+    status = 'unknown'
+
+    async def send_and_record_status(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = str(message['status'])
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_and_record_status)
+    finally:
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                        method=scope['method'], route=scope['path'], status=status)
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        if handler:
+            return await timed_route(handler, scope, receive, send)
+    return await flask_application(scope, receive, send)
+
+# --- Main Execution ---
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(application, host='0.0.0.0', port=SERVER_PORT)
@@ -0,0 +1,366 @@
+"""
+API 부하 테스트 / 벤치마크
+
+임시 BASE_DIR(가상 프로젝트 폴더)과 임시 DB로 서버를 별도 프로세스로 띄운 뒤,
+시나리오별로 요청을 지정한 동시성으로 보내고 p50/p95/p99 지연 시간과 초당 요청 수를 출력합니다.
+동시성이나 저장소 관련 변경을 운영에 반영하기 전에 전후 수치를 비교하는 용도입니다.
+
+시나리오:
+    query     POST /api/query (echo 백엔드, CLI 프로세스 없음)
+    slow      POST /api/query (gemini 백엔드 = fake_cli.py, 느린 모델 실행 흉내)
+    stream    POST /api/query/stream (gemini 백엔드 = fake_cli.py, 첫 chunk까지 시간도 측정)
+    history   GET  /api/history
+    sessions  GET  /api/history/sessions
+    projects  GET  /api/projects
+
+사용법:
+    python benchmarks/bench_api.py
+    python benchmarks/bench_api.py --server serve --workers 4 --concurrency 64 --requests 2000
+    python benchmarks/bench_api.py --scenarios slow,stream --first-byte-delay 2 --slow-requests 100
+    python benchmarks/bench_api.py --json result.json --max-p95-ms 50
+
+--server: flask (app.run, 스레드), serve (serve.py, waitress 멀티 프로세스), asgi (uvicorn asgi:application)
+실패한 요청이 있거나, --max-p95-ms를 주었을 때 어느 시나리오든 p95가 그 값을 넘으면 종료 코드 1을 반환합니다 (회귀 확인용).
+(필요 패키지: requests, bcrypt / serve는 waitress, asgi는 uvicorn과 a2wsgi)
+"""
+import argparse
+import json
+import os
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_CLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_cli.py')
+SCENARIOS = ('query', 'slow', 'stream', 'history', 'sessions', 'projects')
+SLOW_SCENARIOS = ('slow', 'stream')
+BENCH_USER = 'bench'
+
+# --- Test Environment ---
+def make_projects(base_dir, count):
+    """포트 감지 대상 파일이 있는 가상의 프로젝트 폴더를 만듭니다."""
+    for i in range(count):
+        path = os.path.join(base_dir, f"project-{i:03d}")
+        os.makedirs(path)
+        with open(os.path.join(path, 'app.py'), 'w', encoding='utf-8') as f:
+            f.write(f"from flask import Flask\napp = Flask(__name__)\napp.run(port={6000 + i})\n")
+    return sorted(os.listdir(base_dir))
+
+def install_fake_cli(bin_dir):
+    """fake_cli.py를 'gemini' 명령으로 실행되게 만듭니다 (bin_dir은 PATH 맨 앞에 추가)."""
+    if os.name == 'nt':
+        with open(os.path.join(bin_dir, 'gemini.cmd'), 'w', encoding='utf-8') as f:
+            f.write(f'@"{sys.executable}" "{FAKE_CLI}" %*\n')
+    else:
+        path = os.path.join(bin_dir, 'gemini')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"#!/bin/sh\nexec '{sys.executable}' '{FAKE_CLI}' \"$@\"\n")
+        os.chmod(path, 0o755)
+
+def server_env(args, tmp, password):
+    env = dict(os.environ)
+    bin_dir = os.path.join(tmp, 'bin')
+    os.makedirs(bin_dir)
+    install_fake_cli(bin_dir)
+    # 저장소 .env의 값보다 우선하도록 환경 변수로 지정 (load_dotenv는 기존 값을 덮어쓰지 않음)
+    password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds=4)).decode('utf-8')
+    env.update({
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+        'BASE_DIR': os.path.join(tmp, 'projects'),
+        'DB_FILE': os.path.join(tmp, 'bench.db'),
+        'ALLOWED_USERS': f"{BENCH_USER}:{password_hash}",
+        'SERVER_PORT': str(args.port),
+        'WEB_HOST': '127.0.0.1',
+        'WEB_WORKERS': str(args.workers),
+        'RESPONSE_CACHE': 'false',
+        # 한 사용자로 부하를 주므로 요청 빈도 제한은 기본적으로 끔 (--rate-limit이면 서버 설정 사용)
+        'RATE_LIMIT': 'true' if args.rate_limit else 'false',
+        'FAKE_CLI_FIRST_BYTE_DELAY': str(args.first_byte_delay),
+        'FAKE_CLI_CHUNKS': str(args.chunks),
+        'FAKE_CLI_CHUNK_DELAY': str(args.chunk_delay),
+        'FAKE_CLI_OUTPUT_BYTES': str(args.output_bytes),
+        'PYTHONUNBUFFERED': '1',
+    })
+    if args.slow_concurrency is not None:
+        env['CLI_GEMINI_MAX_CONCURRENCY'] = str(args.slow_concurrency)
+    return env
+
+def server_command(args):
+    if args.server == 'serve':
+        return [sys.executable, 'serve.py']
+    if args.server == 'asgi':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                '--port', str(args.port), '--log-level', 'warning']
+    # app.py의 __main__은 debug=True(리로더)로 실행되므로 같은 초기화 후 스레드 모드로 직접 실행
+    return [sys.executable, '-c',
+            "import app\n"
+            "app.init_db()\n"
+            "app.reset_login_state()\n"
+            "app.refresh_command_cache()\n"
+            f"app.app.run(host='127.0.0.1', port={args.port}, threaded=True)\n"]
+
+def wait_for_server(base_url, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            requests.get(base_url + '/api/auth/status', timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server did not start within {timeout} seconds")
+
+def stop_server(process):
+    if process.poll() is None:
+        process.terminate()  # serve.py는 SIGTERM을 받으면 워커를 정리하고 종료
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+# --- Load Generation ---
+class Client:
+    """스레드마다 하나씩 쓰는 로그인된 HTTP 세션입니다 (requests.Session은 스레드 간 공유하지 않음)."""
+
+    def __init__(self, base_url, cookies):
+        self.local = threading.local()
+        self.base_url = base_url
+        self.cookies = cookies
+
+    @property
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            session.cookies.update(self.cookies)
+        return session
+
+def login(base_url, password):
+    session = requests.Session()
+    response = session.post(base_url + '/api/auth/login', json={'username': BENCH_USER, 'password': password}, timeout=30)
+    if response.status_code != 200:
+        raise RuntimeError(f"Login failed: {response.status_code} {response.text}")
+    return session.cookies.get_dict()
+
+def make_request(client, scenario, i, projects, sessions_per_project):
+    """
+    요청 하나를 보내고 (성공 여부, 상태 코드, 첫 chunk까지 걸린 시간 또는 None)을 반환합니다.
+    지연 시간은 호출자가 측정합니다.
+    """
+    project = projects[i % len(projects)]
+    session_id = f"bench-{project}-{i % sessions_per_project}"
+    http = client.session
+    url = client.base_url
+
+    if scenario in ('query', 'slow'):
+        body = {'cli': 'echo' if scenario == 'query' else 'gemini', 'message': f"bench {scenario} {i}",
+                'projectId': project, 'sessionId': session_id}
+        response = http.post(url + '/api/query', json=body, timeout=300)
+        return response.status_code == 200 and 'assistant_message' in response.json(), response.status_code, None
+
+    if scenario == 'stream':
+        body = {'cli': 'gemini', 'message': f"bench stream {i}", 'projectId': project, 'sessionId': session_id}
+        started = time.perf_counter()
+        first_chunk = None
+        done = False
+        with http.post(url + '/api/query/stream', json=body, stream=True, timeout=300) as response:
+            for line in response.iter_lines():
+                if line == b'event: chunk' and first_chunk is None:
+                    first_chunk = time.perf_counter() - started
+                elif line == b'event: done':
+                    done = True
+            return done, response.status_code, first_chunk
+
+    if scenario == 'history':
+        response = http.get(url + '/api/history', params={'projectId': project}, timeout=60)
+    elif scenario == 'sessions':
+        response = http.get(url + '/api/history/sessions', params={'projectId': project}, timeout=60)
+    else:
+        response = http.get(url + '/api/projects', timeout=60)
+    return response.status_code == 200, response.status_code, None
+
+def run_scenario(client, scenario, count, concurrency, projects, sessions_per_project):
+    latencies = []
+    first_chunks = []
+    statuses = {}
+    errors = 0
+    lock = threading.Lock()
+
+    def task(i):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            ok, status, first_chunk = make_request(client, scenario, i, projects, sessions_per_project)
+        except (requests.RequestException, ValueError) as e:
+            ok, status, first_chunk = False, type(e).__name__, None
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if first_chunk is not None:
+                first_chunks.append(first_chunk)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(task, range(count)))
+    wall = time.perf_counter() - started
+
+    result = {
+        "scenario": scenario,
+        "requests": count,
+        "concurrency": concurrency,
+        "errors": errors,
+        "statuses": statuses,
+        "seconds": round(wall, 3),
+        "rps": round(count / wall, 2) if wall else None,
+    }
+    result.update(latency_stats(latencies, 'ms'))
+    if first_chunks:
+        result.update(latency_stats(first_chunks, 'first_chunk_ms'))
+    return result
+
+def percentile(sorted_values, q):
+    """nearest-rank 분위수"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(q * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def latency_stats(values, prefix):
+    values = sorted(values)
+    stats = {}
+    for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+        stats[f"{prefix}_{name}"] = round(percentile(values, q) * 1000, 2)
+    stats[f"{prefix}_max"] = round(values[-1] * 1000, 2)
+    return stats
+
+def server_stages(client):
+    """
+    서버의 /api/metrics에서 단계별 평균 시간(ms)을 모으고 지표를 초기화합니다.
+    serve.py로 여러 워커를 띄운 경우 요청을 받은 워커 하나의 값입니다.
+    """
+    try:
+        summary = client.session.get(client.base_url + '/api/metrics', params={'reset': '1'}, timeout=30).json()
+    except (requests.RequestException, ValueError):
+        return {}
+    totals = {}
+    for entry in summary.get('histograms', {}).get('query_stage_seconds', []):
+        count, weighted = totals.get(entry['stage'], (0, 0.0))
+        totals[entry['stage']] = (count + entry['count'], weighted + (entry['avg'] or 0) * entry['count'])
+    return {stage: round(weighted / count * 1000, 2) for stage, (count, weighted) in totals.items() if count}
+
+def seed_history(client, rows, concurrency, projects, sessions_per_project):
+    """history/sessions 시나리오가 빈 테이블을 읽지 않도록 echo 쿼리로 대화를 미리 쌓습니다."""
+    if rows > 0:
+        result = run_scenario(client, 'query', rows, concurrency, projects, sessions_per_project)
+        if result['errors']:
+            raise RuntimeError(f"Seeding failed: {result['statuses']}")
+
+def print_table(results):
+    columns = [('scenario', 9), ('requests', 8), ('errors', 6), ('rps', 9), ('ms_p50', 9), ('ms_p95', 9),
+               ('ms_p99', 9), ('ms_max', 9), ('first_chunk_ms_p95', 18)]
+    print(' '.join(name.rjust(width) for name, width in columns))
+    for result in results:
+        cells = []
+        for name, width in columns:
+            value = result.get(name)
+            cells.append(('-' if value is None else str(value)).rjust(width))
+        print(' '.join(cells))
+        if result.get('stages_ms'):
+            stages = ', '.join(f"{stage}={ms}" for stage, ms in sorted(result['stages_ms'].items()))
+            print(f"{'':9}  server stages avg ms: {stages}")
+
+def main():
+    parser = argparse.ArgumentParser(description="API load test against a temporary server")
+    parser.add_argument('--server', choices=('flask', 'serve', 'asgi'), default='flask', help="서버 실행 방식")
+    parser.add_argument('--workers', type=int, default=2, help="--server serve의 워커 프로세스 수 (WEB_WORKERS)")
+    parser.add_argument('--port', type=int, default=None, help="서버 포트 (기본값: 빈 포트)")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="쉼표로 구분한 시나리오 목록")
+    parser.add_argument('--concurrency', type=int, default=16, help="동시 요청 수")
+    parser.add_argument('--requests', type=int, default=500, help="빠른 시나리오별 요청 수")
+    parser.add_argument('--slow-requests', type=int, default=32, help="slow/stream 시나리오별 요청 수")
+    parser.add_argument('--slow-concurrency', type=int, default=None,
+                        help="gemini 백엔드 동시 실행 제한 (CLI_GEMINI_MAX_CONCURRENCY, 0이면 제한 없음)")
+    parser.add_argument('--rate-limit', action='store_true', help="요청 빈도 제한(RATE_LIMIT_*)을 켠 채로 측정")
+    parser.add_argument('--projects', type=int, default=20, help="생성할 프로젝트 수")
+    parser.add_argument('--sessions', type=int, default=5, help="프로젝트별 세션 수")
+    parser.add_argument('--seed-rows', type=int, default=1000, help="측정 전에 쌓아 둘 대화 수")
+    parser.add_argument('--first-byte-delay', type=float, default=0.5, help="가짜 CLI의 첫 출력까지 대기(초)")
+    parser.add_argument('--chunks', type=int, default=20, help="가짜 CLI의 출력 조각 수")
+    parser.add_argument('--chunk-delay', type=float, default=0.05, help="가짜 CLI의 조각 사이 대기(초)")
+    parser.add_argument('--output-bytes', type=int, default=2000, help="가짜 CLI의 출력 크기")
+    parser.add_argument('--json', help="결과를 JSON 파일로 저장")
+    parser.add_argument('--max-p95-ms', type=float, default=None, help="시나리오별 허용 최대 p95(ms)")
+    parser.add_argument('--keep', action='store_true', help="임시 폴더(DB, 서버 로그)를 지우지 않음")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    if args.port is None:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            args.port = s.getsockname()[1]
+
+    tmp = tempfile.mkdtemp(prefix='api-bench-')
+    os.makedirs(os.path.join(tmp, 'projects'))
+    projects = make_projects(os.path.join(tmp, 'projects'), args.projects)
+    password = secrets.token_urlsafe(16)
+    base_url = f"http://127.0.0.1:{args.port}"
+
+    log = open(os.path.join(tmp, 'server.log'), 'w', encoding='utf-8')
+    process = subprocess.Popen(server_command(args), cwd=ROOT, env=server_env(args, tmp, password),
+                               stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_server(base_url, process)
+        client = Client(base_url, login(base_url, password))
+        seed_history(client, args.seed_rows, args.concurrency, projects, args.sessions)
+        server_stages(client)
+
+        print(f"server={args.server} workers={args.workers if args.server == 'serve' else 1} "
+              f"concurrency={args.concurrency} projects={args.projects} seed_rows={args.seed_rows}")
+        results = []
+        for scenario in scenarios:
+            count = args.slow_requests if scenario in SLOW_SCENARIOS else args.requests
+            result = run_scenario(client, scenario, count, args.concurrency, projects, args.sessions)
+            result['stages_ms'] = server_stages(client)
+            results.append(result)
+        print_table(results)
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+        failed = [r['scenario'] for r in results if r['errors']]
+        if failed:
+            print(f"FAIL: errors in {', '.join(failed)} (see statuses in --json output)")
+        slow = []
+        if args.max_p95_ms is not None:
+            slow = [r['scenario'] for r in results if r['ms_p95'] > args.max_p95_ms]
+            if slow:
+                print(f"FAIL: p95 exceeds --max-p95-ms {args.max_p95_ms} in {', '.join(slow)}")
+        return 1 if failed or slow else 0
+    finally:
+        stop_server(process)
+        log.close()
+        if args.keep:
+            print(f"Kept {tmp}")
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+"""
+포트 감지(detect_project_port) 마이크로 벤치마크
+
+큰 app.py 파일을 가진 가상의 프로젝트 트리를 임시 폴더에 만들고,
+이전 방식(파일 전체를 읽고 규칙마다 re.search)과 현재 단일 패스 스캐너의 결과와 속도를 비교합니다.
+
+사용법:
+    python benchmarks/bench_port_detection.py
+    python benchmarks/bench_port_detection.py --projects 200 --size-kb 512 --max-ms 5
+
+--max-ms를 주면 프로젝트당 평균 감지 시간이 그 값을 넘을 때 종료 코드 1을 반환합니다 (회귀 확인용).
+"""
+import argparse
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('ALLOWED_USERS', 'bench:unused')
+os.environ.setdefault('PROJECT_WATCH', 'false')
+
+from app import detect_project_port, PORT_SCAN_CHUNK  # noqa: E402
+
+FILLER_LINES = [
+    "from module_{n} import helper_{n}  # import 줄에도 'port'가 들어 있음\n",
+    "def handler_{n}(request):\n",
+    "    value = compute_{n}(request.args.get('key'))  # 처리\n",
+    "    return jsonify({{'result': value, 'count': {n}}})\n",
+    "\n",
+]
+
+def legacy_get_project_port(project_path):
+    """이전 구현 (결과 비교 및 속도 기준용)"""
+    def read_file_safe(file_path):
+        for encoding in ['utf-8', 'cp949', 'latin-1']:
+            try:
+                with open(file_path, 'r', encoding=encoding) as f:
+                    return f.read()
+            except Exception:
+                continue
+        return None
+
+    port_file = os.path.join(project_path, '.port')
+    if os.path.exists(port_file):
+        content = read_file_safe(port_file)
+        if content and content.strip().isdigit():
+            return int(content.strip())
+
+    env_file = os.path.join(project_path, '.env')
+    if os.path.exists(env_file):
+        content = read_file_safe(env_file)
+        if content:
+            match = re.search(r'@port:\s*(\d+)', content)
+            if match:
+                return int(match.group(1))
+            match = re.search(r'(?:SERVER_PORT|PORT)\s*=\s*(\d+)', content)
+            if match:
+                return int(match.group(1))
+
+    app_py = os.path.join(project_path, 'app.py')
+    if os.path.exists(app_py):
+        content = read_file_safe(app_py)
+        if content:
+            match = re.search(r'@port:\s*(\d+)', content)
+            if match:
+                return int(match.group(1))
+            match = re.search(r'port\s*=\s*(\d+)', content)
+            if match:
+                return int(match.group(1))
+            match = re.search(r'(?:SERVER_PORT|PORT)\s*=\s*(?:int\()?(\d+)', content)
+            if match:
+                return int(match.group(1))
+            match = re.search(r'port["\']?\s*[:=]\s*(\d{4,5})', content, re.IGNORECASE)
+            if match:
+                return int(match.group(1))
+    return None
+
+def make_tree(root, projects, size_kb, seed):
+    """규칙별로 골고루 섞인 가상의 프로젝트 폴더를 만듭니다."""
+    rng = random.Random(seed)
+    paths = []
+    for i in range(projects):
+        path = os.path.join(root, f"project-{i:04d}")
+        os.makedirs(path)
+        port = 3000 + i
+        kind = i % 6
+
+        body = []
+        size = 0
+        n = 0
+        while size < size_kb * 1024:
+            line = FILLER_LINES[n % len(FILLER_LINES)].format(n=n)
+            body.append(line)
+            size += len(line)
+            n += 1
+        if kind == 0:
+            body.insert(0, f"# @port: {port}\n")
+        elif kind == 1:
+            body.append(f"if __name__ == '__main__':\n    app.run(host='0.0.0.0', port={port})\n")
+        elif kind == 2:
+            body.append(f"SERVER_PORT = int(os.getenv('SERVER_PORT', '{port}'))\n")
+        elif kind == 3:
+            body.append(f"CONFIG = {{'port': {port}}}\n")
+        elif kind == 4:
+            with open(os.path.join(path, '.env'), 'w', encoding='utf-8') as f:
+                f.write(f"DEBUG=1\nPORT={port}\n")
+        elif kind == 5 and rng.random() < 0.5:
+            with open(os.path.join(path, '.port'), 'w', encoding='utf-8') as f:
+                f.write(str(port))
+
+        with open(os.path.join(path, 'app.py'), 'w', encoding='utf-8') as f:
+            f.writelines(body)
+        paths.append(path)
+    return paths
+
+# 경계 사례 생성용 조각: 규칙 사이의 공백에 줄바꿈이 들어가는 경우를 섞음
+EDGE_TOKENS = ['port', 'PORT', 'Port', 'SERVER_PORT', '@port:', '@', '=', ':', '"', "'", 'int(',
+               ' ', '  ', '\n', '\n\n', '\t', '5000', '80', '12345', '8080', 'x', 'run(', ',']
+
+def make_edge_cases(root, count, seed):
+    """
+    줄바꿈을 넘는 패턴('PORT =\\n5000', '@port:\\n3000' 등)을 무작위로 만들어 .env 또는 app.py에 씁니다.
+    절반은 패턴이 청크 경계(PORT_SCAN_CHUNK)에 걸치도록 앞을 채웁니다.
+    """
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(root, f"edge-{i:05d}")
+        os.makedirs(path)
+        padding = PORT_SCAN_CHUNK - rng.randint(0, 24) if i % 2 else rng.randint(0, 40)
+        prefix = ('x' * 63 + '\n') * (padding // 64) + 'x' * (padding % 64)
+        tokens = ''.join(rng.choice(EDGE_TOKENS) for _ in range(rng.randint(3, 12)))
+        file_name = '.env' if rng.random() < 0.3 else 'app.py'
+        with open(os.path.join(path, file_name), 'w', encoding='utf-8', newline='') as f:
+            f.write(prefix + tokens)
+        paths.append(path)
+    return paths
+
+def time_per_project(func, paths, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            func(path)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(paths) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Port detection micro-benchmark")
+    parser.add_argument('--projects', type=int, default=60, help="생성할 프로젝트 수")
+    parser.add_argument('--size-kb', type=int, default=1024, help="app.py 크기(KB)")
+    parser.add_argument('--repeat', type=int, default=3, help="반복 횟수 (최솟값 사용)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-ms', type=float, default=None, help="프로젝트당 허용 최대 시간(ms)")
+    parser.add_argument('--edge-cases', type=int, default=2000, help="결과 비교에만 쓰는 줄바꿈/청크 경계 사례 수")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='port-bench-')
+    try:
+        paths = make_tree(root, args.projects, args.size_kb, args.seed)
+
+        edge_paths = make_edge_cases(root, args.edge_cases, args.seed)
+
+        mismatches = [
+            path for path in paths + edge_paths
+            if detect_project_port(path)[0] != legacy_get_project_port(path)
+        ]
+        if mismatches:
+            print(f"FAIL: {len(mismatches)} project(s) differ from the legacy detector, e.g. {mismatches[0]}")
+            return 1
+
+        legacy_ms = time_per_project(legacy_get_project_port, paths, args.repeat)
+        current_ms = time_per_project(detect_project_port, paths, args.repeat)
+
+        print(f"projects={args.projects} app.py={args.size_kb}KB repeat={args.repeat}")
+        print(f"legacy : {legacy_ms:8.3f} ms/project")
+        print(f"current: {current_ms:8.3f} ms/project  ({legacy_ms / current_ms:.1f}x)")
+
+        if args.max_ms is not None and current_ms > args.max_ms:
+            print(f"FAIL: {current_ms:.3f} ms/project exceeds --max-ms {args.max_ms}")
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+"""
+벤치마크용 가짜 LLM CLI
+
+gemini CLI와 같은 인자(--model <model> prompt <message>)를 받아, 실제 모델처럼
+첫 출력까지 기다린 뒤 응답을 여러 조각으로 나눠 천천히 출력합니다. 네트워크나 API 키가 필요 없습니다.
+bench_api.py가 임시 폴더에 'gemini' 이름의 실행 파일로 연결해 PATH 앞에 두므로,
+서버는 실제 gemini 백엔드 경로(명령 확인, 프로세스 실행, 스트리밍, 저장)를 그대로 거칩니다.
+
+동작은 환경 변수로 조절합니다:
+    FAKE_CLI_FIRST_BYTE_DELAY  첫 출력까지 대기 시간(초, 기본값 0.5)
+    FAKE_CLI_CHUNKS            출력 조각 수 (기본값 20)
+    FAKE_CLI_CHUNK_DELAY       조각 사이 대기 시간(초, 기본값 0.05)
+    FAKE_CLI_OUTPUT_BYTES      전체 출력 크기(바이트, 기본값 2000)
+    FAKE_CLI_EXIT_CODE         종료 코드 (기본값 0, 0이 아니면 stderr에 오류 메시지 출력)
+
+직접 실행:
+    python benchmarks/fake_cli.py prompt "hello"
+"""
+import os
+import sys
+import time
+
+def parse_message(argv):
+    """'prompt' 다음 인자를 메시지로 사용합니다 (--model 등 다른 옵션은 무시)."""
+    if 'prompt' in argv:
+        index = argv.index('prompt')
+        if index + 1 < len(argv):
+            return argv[index + 1]
+    return argv[-1] if argv else ''
+
+def build_output(message, size):
+    header = f"Fake response to: {message}\n"
+    filler = "lorem ipsum dolor sit amet consectetur adipiscing elit "
+    body = (filler * (max(size - len(header), 0) // len(filler) + 1))[:max(size - len(header), 0)]
+    return header + body
+
+def main():
+    first_byte_delay = float(os.getenv('FAKE_CLI_FIRST_BYTE_DELAY', '0.5'))
+    chunks = max(1, int(os.getenv('FAKE_CLI_CHUNKS', '20')))
+    chunk_delay = float(os.getenv('FAKE_CLI_CHUNK_DELAY', '0.05'))
+    output_bytes = int(os.getenv('FAKE_CLI_OUTPUT_BYTES', '2000'))
+    exit_code = int(os.getenv('FAKE_CLI_EXIT_CODE', '0'))
+
+    output = build_output(parse_message(sys.argv[1:]), output_bytes)
+    time.sleep(first_byte_delay)
+    if exit_code:
+        sys.stderr.write("fake cli: simulated failure\n")
+        return exit_code
+
+    step = max(1, -(-len(output) // chunks))
+    for start in range(0, len(output), step):
+        if start:
+            time.sleep(chunk_delay)
+        sys.stdout.write(output[start:start + step])
+        sys.stdout.flush()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""
+운영용 실행 스크립트입니다: python serve.py
+
+WEB_WORKERS개의 워커 프로세스가 하나의 리스닝 소켓을 공유하여 요청을 나눠 처리합니다.
+각 워커는 waitress WSGI 서버(WEB_THREADS개 스레드)로 Flask 앱을 실행하며, 비정상 종료된 워커는 다시 띄웁니다.
+로그인 시도/잠금 상태와 세션 secret key는 DB에 저장되므로 모든 워커가 공유하고 워커가 재시작되어도 세션이 유지됩니다.
+백엔드 동시 실행 수, 작업 큐 워커 수, 상주 CLI 프로세스 수 제한은 워커 수로 나눠 워커마다 따로 적용됩니다 (app.per_worker).
+(필요 패키지: pip install waitress)
+"""
+import multiprocessing
+import signal
+import socket
+import time
+
+# 워커가 시작 직후 계속 죽는 경우 재시작 사이에 두는 대기 시간(초)
+WORKER_RESTART_DELAY = 1.0
+
+def worker_main(listener, worker_id):
+    """워커 프로세스: 공유 소켓에서 요청을 받아 처리합니다."""
+    from waitress import serve
+    import app as application
+
+    application.init_db()
+    print(f"Worker {worker_id} started.")
+    serve(application.app, sockets=[listener], threads=application.WEB_THREADS, ident='remoteChat-cli')
+
+def start_worker(context, listener, worker_id):
+    process = context.Process(target=worker_main, args=(listener, worker_id), name=f"web-worker-{worker_id}", daemon=True)
+    process.start()
+    return process
+
+def main():
+    from multiprocessing.connection import wait
+    from app import startup, SERVER_PORT, WEB_WORKERS, WEB_HOST
+
+    startup()
+
+    listener = socket.create_server((WEB_HOST, SERVER_PORT), backlog=1024)
+    # Windows에서도 동작하도록 fork 대신 spawn으로 워커를 띄우고 소켓을 넘겨줌
+    context = multiprocessing.get_context('spawn')
+    workers = {worker_id: start_worker(context, listener, worker_id) for worker_id in range(WEB_WORKERS)}
+    print(f"Serving on http://{WEB_HOST}:{SERVER_PORT} with {WEB_WORKERS} worker(s).")
+
+    def shutdown(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, shutdown)
+
+    try:
+        while True:
+            wait([worker.sentinel for worker in workers.values()])
+            for worker_id, worker in list(workers.items()):
+                if worker.is_alive():
+                    continue
+                print(f"Worker {worker_id} exited with code {worker.exitcode}. Restarting...")
+                time.sleep(WORKER_RESTART_DELAY)
+                workers[worker_id] = start_worker(context, listener, worker_id)
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+    finally:
+        for worker in workers.values():
+            worker.terminate()
+        for worker in workers.values():
+            worker.join(5)
+        listener.close()
+
+if __name__ == '__main__':
+    main()